@@ -0,0 +1,179 @@
+from __future__ import unicode_literals
+
+"""
+A local disk cache for files downloaded from GS.
+"""
+
+import os, base64, hashlib, tempfile, threading
+from collections import namedtuple
+
+from django.utils.encoding import force_bytes, force_text
+
+
+CacheEntry = namedtuple("CacheEntry", ("etag", "path"))
+
+
+# Eviction shrinks the cache to this fraction of its maximum size, so it isn't
+# needed again until more files are cached.
+EVICT_RATIO = 0.9
+
+
+class DiskCache(object):
+
+    """
+    A size-capped cache of file contents in a local directory, keyed by name
+    and ETag.
+
+    Each cached name has its own subdirectory, containing a single file named
+    after its ETag. Files are written atomically, so the cache can be shared
+    between processes. When the cache grows beyond `max_size` bytes, the
+    least recently used files are evicted.
+
+    The cache size is tracked as files are added and removed, and only
+    recalculated from disk when it grows beyond `max_size`, picking up files
+    cached by other processes.
+    """
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # The size of the cache, or None if it hasn't been calculated yet.
+        self._size = None
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def _get_entry_dir(self, name):
+        return os.path.join(self.directory, hashlib.sha1(force_bytes(name)).hexdigest())
+
+    def get(self, name):
+        """
+        Returns the `CacheEntry` for the given name, or None if it is not
+        cached.
+        """
+        entry_dir = self._get_entry_dir(name)
+        try:
+            filenames = os.listdir(entry_dir)
+        except OSError:
+            return None
+        for filename in filenames:
+            if not filename.endswith(".tmp"):
+                return CacheEntry(
+                    etag = force_text(base64.urlsafe_b64decode(force_bytes(filename))),
+                    path = os.path.join(entry_dir, filename),
+                )
+        return None
+
+    def touch(self, entry):
+        """Marks the given entry as recently used."""
+        try:
+            os.utime(entry.path, None)
+        except OSError:
+            pass
+
+    def temporary_file(self):
+        """
+        Returns a temporary file in the cache directory, ready to be passed
+        to `put()`.
+        """
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+
+    def put(self, name, etag, temp_path):
+        """
+        Moves the given temporary file into the cache, replacing any older
+        version of the file.
+
+        Returns the new `CacheEntry`.
+        """
+        entry_dir = self._get_entry_dir(name)
+        try:
+            os.mkdir(entry_dir)
+        except OSError:
+            pass
+        entry = CacheEntry(
+            etag = etag,
+            path = os.path.join(entry_dir, force_text(base64.urlsafe_b64encode(force_bytes(etag)))),
+        )
+        os.rename(temp_path, entry.path)
+        size = os.path.getsize(entry.path)
+        # Remove old versions.
+        for filename in os.listdir(entry_dir):
+            path = os.path.join(entry_dir, filename)
+            if path != entry.path:
+                size -= self._remove_file(path) or 0
+        self._add_size(size)
+        self.evict()
+        return entry
+
+    def delete(self, name):
+        """Removes the given name from the cache."""
+        entry_dir = self._get_entry_dir(name)
+        try:
+            filenames = os.listdir(entry_dir)
+        except OSError:
+            return
+        size = 0
+        for filename in filenames:
+            size += self._remove(os.path.join(entry_dir, filename))
+        self._add_size(-size)
+
+    def _add_size(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+
+    def _remove_file(self, path):
+        """Removes the given file, returning its size, or None if it is missing."""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return None
+        return size
+
+    def _remove(self, path):
+        size = self._remove_file(path)
+        if size is None:
+            return 0
+        # Clean up empty entry directories.
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        return size
+
+    def evict(self):
+        """
+        Removes the least recently used files if the cache is larger than
+        `max_size`, until it is smaller than `max_size * EVICT_RATIO`.
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+            files = []
+            total_size = 0
+            for dirpath, dirnames, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    # Files being downloaded are not in the cache yet.
+                    if filename.endswith(".tmp"):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total_size += stat.st_size
+            if total_size > self.max_size:
+                files.sort()
+                for mtime, size, path in files:
+                    self._remove(path)
+                    total_size -= size
+                    if total_size <= self.max_size * EVICT_RATIO:
+                        break
+            self._size = total_size
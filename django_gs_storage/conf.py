@@ -5,6 +5,8 @@ Settings used by django-gs-storage.
 """
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
 class LazySetting(object):
@@ -20,7 +22,11 @@ class LazySetting(object):
     def __get__(self, obj, cls):
         if obj is None:
             return self
-        return getattr(obj._settings, self.name, self.default)
+        try:
+            return obj._cache[self.name]
+        except KeyError:
+            value = obj._cache[self.name] = getattr(obj._settings, self.name, self.default)
+            return value
 
 
 class LazySettings(object):
@@ -28,12 +34,17 @@ class LazySettings(object):
     """
     A proxy to gs-specific django settings.
 
-    Settings are resolved at runtime, allowing tests
+    Settings are resolved on first access, and cached until
+    the `setting_changed` signal is sent, allowing tests
     to change settings at runtime.
     """
 
     def __init__(self, settings):
         self._settings = settings
+        self._cache = {}
+
+    def clear(self):
+        self._cache = {}
 
     GCP_REGION = LazySetting(
         name = "GCP_REGION",
@@ -56,7 +67,7 @@ class LazySettings(object):
 
     GCP_GS_CALLING_FORMAT = LazySetting(
         name = "GCP_GS_CALLING_FORMAT",
-        default = "boto.gs.connection.OrdinaryCallingFormat",
+        default = "boto.s3.connection.OrdinaryCallingFormat",
     )
 
     GCP_GS_HOST = LazySetting(
@@ -100,6 +111,94 @@ class LazySettings(object):
         default = True
     )
 
+    GCP_GS_METRICS = LazySetting(
+        name = "GCP_GS_METRICS",
+        default = False,
+    )
+
+    GCP_GS_SPOOL_MAX_SIZE = LazySetting(
+        name = "GCP_GS_SPOOL_MAX_SIZE",
+        default = 1024 * 1024 * 10,  # 10 MB.
+    )
+
+    GCP_GS_SPOOL_MAX_TOTAL_SIZE = LazySetting(
+        name = "GCP_GS_SPOOL_MAX_TOTAL_SIZE",
+        default = 0,  # Unlimited.
+    )
+
+    GCP_GS_SPOOL_DIR = LazySetting(
+        name = "GCP_GS_SPOOL_DIR",
+    )
+
+    GCP_GS_SPOOL_MMAP = LazySetting(
+        name = "GCP_GS_SPOOL_MMAP",
+        default = False,
+    )
+
+    GCP_GS_DISK_CACHE_DIR = LazySetting(
+        name = "GCP_GS_DISK_CACHE_DIR",
+    )
+
+    GCP_GS_DISK_CACHE_MAX_SIZE = LazySetting(
+        name = "GCP_GS_DISK_CACHE_MAX_SIZE",
+        default = 1024 * 1024 * 1024,  # 1 GB.
+    )
+
+    GCP_GS_CONTENT_ADDRESSED = LazySetting(
+        name = "GCP_GS_CONTENT_ADDRESSED",
+        default = False,
+    )
+
+    GCP_GS_WRITE_BEHIND_DIR = LazySetting(
+        name = "GCP_GS_WRITE_BEHIND_DIR",
+    )
+
+    GCP_GS_WRITE_BEHIND_WORKERS = LazySetting(
+        name = "GCP_GS_WRITE_BEHIND_WORKERS",
+        default = 4,
+    )
+
+    GCP_GS_WRITE_BEHIND_RETRIES = LazySetting(
+        name = "GCP_GS_WRITE_BEHIND_RETRIES",
+        default = 5,
+    )
+
+    GCP_GS_WRITE_BEHIND_URL = LazySetting(
+        name = "GCP_GS_WRITE_BEHIND_URL",
+    )
+
+    GCP_GS_BUCKET_NAMES = LazySetting(
+        name = "GCP_GS_BUCKET_NAMES",
+        default = (),
+    )
+
+    GCP_GS_KEY_PREFIX_SHARDS = LazySetting(
+        name = "GCP_GS_KEY_PREFIX_SHARDS",
+        default = 0,
+    )
+
+    GCP_GS_READ_BUCKET_NAMES = LazySetting(
+        name = "GCP_GS_READ_BUCKET_NAMES",
+        default = {},
+    )
+
+    GCP_GS_URL_STRATEGY = LazySetting(
+        name = "GCP_GS_URL_STRATEGY",
+        default = "django_gs_storage.url_strategies.DefaultUrlStrategy",
+    )
+
+    GCP_GS_URL_VERSION = LazySetting(
+        name = "GCP_GS_URL_VERSION",
+    )
+
+    GCP_GS_CDN_KEY_NAME = LazySetting(
+        name = "GCP_GS_CDN_KEY_NAME",
+    )
+
+    GCP_GS_CDN_KEY = LazySetting(
+        name = "GCP_GS_CDN_KEY",
+    )
+
     # Static storage config.
 
     GCP_GS_BUCKET_NAME_STATIC = LazySetting(
@@ -108,7 +207,7 @@ class LazySettings(object):
 
     GCP_GS_CALLING_FORMAT_STATIC = LazySetting(
         name = "GCP_GS_CALLING_FORMAT_STATIC",
-        default = "boto.gs.connection.OrdinaryCallingFormat",
+        default = "boto.s3.connection.OrdinaryCallingFormat",
     )
 
     GCP_GS_HOST_STATIC = LazySetting(
@@ -152,5 +251,29 @@ class LazySettings(object):
         default = True
     )
 
+    GCP_GS_MANIFEST_PATH_STATIC = LazySetting(
+        name = "GCP_GS_MANIFEST_PATH_STATIC",
+    )
+
+    GCP_GS_MANIFEST_CACHE_STATIC = LazySetting(
+        name = "GCP_GS_MANIFEST_CACHE_STATIC",
+    )
+
+    GCP_GS_MANIFEST_VERIFY_STATIC = LazySetting(
+        name = "GCP_GS_MANIFEST_VERIFY_STATIC",
+        default = True,
+    )
+
+    GCP_GS_FAST_POST_PROCESS_STATIC = LazySetting(
+        name = "GCP_GS_FAST_POST_PROCESS_STATIC",
+        default = False,
+    )
+
 
 settings = LazySettings(settings)
+
+
+@receiver(setting_changed)
+def clear_settings(setting, **kwargs):
+    if setting.startswith("GCP_"):
+        settings.clear()
@@ -0,0 +1,222 @@
+from __future__ import unicode_literals
+
+"""
+File helpers used by django-gs-storage.
+"""
+
+import io, os, mmap, codecs, threading
+from tempfile import SpooledTemporaryFile
+
+
+class EncodedTextFile(io.RawIOBase):
+
+    """
+    A readable, seekable bytes view of a text-mode file.
+
+    Text is encoded lazily as it is read, so at most one chunk of encoded
+    content is held in memory at a time. Seeking backwards rewinds the
+    underlying file and re-encodes from the start.
+    """
+
+    def __init__(self, file, encoding="utf-8", chunk_size=64*1024):
+        super(EncodedTextFile, self).__init__()
+        self._file = file
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+        self._start = file.tell()
+        self._size = None
+        self._rewind()
+
+    def _rewind(self):
+        self._file.seek(self._start)
+        self._encoder = codecs.getincrementalencoder(self._encoding)()
+        self._buffer = b""
+        self._offset = 0
+        self._position = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Encodes the next chunk of text into the buffer.
+
+        Returns False at the end of the file.
+        """
+        while self._offset >= len(self._buffer):
+            if self._eof:
+                return False
+            text = self._file.read(self._chunk_size)
+            self._eof = not text
+            self._buffer = self._encoder.encode(text, final=self._eof)
+            self._offset = 0
+        return True
+
+    def _skip(self, count):
+        while count > 0 and self._fill():
+            skipped = min(count, len(self._buffer) - self._offset)
+            self._offset += skipped
+            self._position += skipped
+            count -= skipped
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        total = 0
+        while total < len(b) and self._fill():
+            count = min(len(b) - total, len(self._buffer) - self._offset)
+            b[total:total + count] = self._buffer[self._offset:self._offset + count]
+            self._offset += count
+            total += count
+        self._position += total
+        return total
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            if self._size is None:
+                self._skip(float("inf"))
+                self._size = self._position
+            offset += self._size
+        if offset < self._position:
+            self._rewind()
+        self._skip(offset - self._position)
+        return self._position
+
+
+class SpoolBudget(object):
+
+    """
+    Tracks the memory used by in-flight spooled temporary files.
+
+    If `max_size` is set, reservations that would take the total over
+    `max_size` bytes are refused.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        with self._lock:
+            if self.max_size and self.used + size > self.max_size:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+
+class BudgetedSpooledTemporaryFile(SpooledTemporaryFile):
+
+    """
+    A spooled temporary file that reserves its in-memory size from a
+    `SpoolBudget`.
+
+    If the budget is exhausted, the file rolls over to disk early.
+    """
+
+    def __init__(self, budget, max_size=0, dir=None):
+        self._budget = budget
+        self._reserved = 0
+        SpooledTemporaryFile.__init__(self, max_size=max_size, dir=dir)
+        # Without an in-memory size, go straight to disk.
+        if not max_size:
+            self.rollover()
+
+    def _release(self):
+        if self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
+
+    def write(self, s):
+        if not self._rolled:
+            end = self._file.tell() + len(s)
+            if end > self._reserved:
+                if end > self._max_size or not self._budget.reserve(end - self._reserved):
+                    self.rollover()
+                else:
+                    self._reserved = end
+        return SpooledTemporaryFile.write(self, s)
+
+    def writelines(self, iterable):
+        for line in iterable:
+            self.write(line)
+
+    def rollover(self):
+        SpooledTemporaryFile.rollover(self)
+        self._release()
+
+    def close(self):
+        self._release()
+        SpooledTemporaryFile.close(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self._release()
+
+
+class MmapFile(object):
+
+    """
+    A read-only file backed by a memory map of another file.
+
+    Reads are served from the page cache, rather than copied onto the heap.
+    If `close_file` is False, closing the map leaves the mapped file open.
+    """
+
+    def __init__(self, file, close_file=True):
+        self._file = file
+        self._close_file = close_file
+        self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def closed(self):
+        return self._mmap.closed
+
+    @property
+    def size(self):
+        return len(self._mmap)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._mmap) - self._mmap.tell()
+        return self._mmap.read(size)
+
+    def readline(self, size=-1):
+        return self._mmap.readline()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def tell(self):
+        return self._mmap.tell()
+
+    def close(self):
+        self._mmap.close()
+        if self._close_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
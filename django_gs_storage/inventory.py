@@ -0,0 +1,221 @@
+from __future__ import unicode_literals
+
+"""
+Local inventory snapshots of the files in a GS storage.
+"""
+
+import os, sqlite3, datetime
+from collections import namedtuple
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from django_gs_storage.storage import _parse_timestamp
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Sorts after any character in a file name, for prefix range queries.
+MAX_CHAR = "\U0010ffff"
+
+SCHEMA = """
+CREATE TABLE inventory (
+    bucket TEXT NOT NULL,
+    key_prefix TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE TABLE files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    modified_time TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    content_type TEXT,
+    content_encoding TEXT
+);
+CREATE INDEX files_modified_time ON files (modified_time);
+"""
+
+
+InventoryEntry = namedtuple("InventoryEntry", (
+    "name",
+    "size",
+    "modified_time",
+    "etag",
+    "content_type",
+    "content_encoding",
+))
+
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT)
+
+
+def _parse_row(row):
+    name, size, modified_time, etag, content_type, content_encoding = row
+    return InventoryEntry(
+        name = name,
+        size = size,
+        modified_time = datetime.datetime.strptime(modified_time, TIMESTAMP_FORMAT),
+        etag = etag,
+        content_type = content_type,
+        content_encoding = content_encoding,
+    )
+
+
+def _get_prefix_range(prefix):
+    return prefix, prefix + MAX_CHAR
+
+
+class Inventory(object):
+
+    """
+    A snapshot of the files in a `GSStorage`, stored in a local SQLite
+    database.
+
+    Create a snapshot with `Inventory.create()`. Queries are answered from
+    the local database, and never touch the network.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError("Inventory {path} does not exist".format(
+                path = path,
+            ))
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self.bucket_name, self.key_prefix, self.prefix, created = self._connection.execute(
+            "SELECT bucket, key_prefix, prefix, created FROM inventory"
+        ).fetchone()
+        self.created = datetime.datetime.strptime(created, TIMESTAMP_FORMAT)
+
+    @classmethod
+    def create(cls, storage, path, prefix="", include_headers=True, max_workers=10, chunk_size=1000):
+        """
+        Snapshots the files in the given storage, starting with `prefix`, into
+        a new SQLite database at `path`.
+
+        File names, sizes, ETags and modified times are taken from a bucket
+        listing. If `include_headers` is True, the content type and encoding
+        of each file are fetched with up to `max_workers` concurrent HEAD
+        requests.
+
+        The database is replaced atomically, so an existing inventory at
+        `path` remains usable until the new one is complete.
+        """
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        pool = ThreadPool(max_workers) if include_headers else None
+        try:
+            connection.executescript(SCHEMA)
+            connection.execute("INSERT INTO inventory VALUES (?, ?, ?, ?)", (
+                storage.gcp_gs_bucket_name,
+                storage.gcp_gs_key_prefix,
+                prefix,
+                _format_timestamp(datetime.datetime.utcnow()),
+            ))
+            keys = iter(storage._list(prefix))
+            while True:
+                chunk = list(islice(keys, chunk_size))
+                if not chunk:
+                    break
+                if pool is not None:
+                    headers = pool.map(lambda name_key: storage._get_key(name_key[0], validate=True), chunk)
+                else:
+                    headers = [None] * len(chunk)
+                connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", [
+                    (
+                        name,
+                        key.size,
+                        _format_timestamp(_parse_timestamp(key.last_modified)),
+                        key.etag,
+                        head_key and head_key.content_type,
+                        head_key and head_key.content_encoding,
+                    )
+                    for (name, key), head_key
+                    in zip(chunk, headers)
+                    # Files deleted since the listing are skipped.
+                    if pool is None or head_key is not None
+                ])
+            connection.commit()
+        except Exception:
+            connection.close()
+            os.remove(temp_path)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+        connection.close()
+        os.rename(temp_path, path)
+        return cls(path)
+
+    def close(self):
+        self._connection.close()
+
+    def matches(self, storage):
+        """Returns True if the snapshot was taken of the given storage's bucket and key prefix."""
+        return (self.bucket_name, self.key_prefix) == (getattr(storage, "gcp_gs_bucket_name", None), getattr(storage, "gcp_gs_key_prefix", None))
+
+    # Queries.
+
+    @property
+    def age(self):
+        """The time elapsed since the snapshot was taken."""
+        return datetime.datetime.utcnow() - self.created
+
+    def get(self, name):
+        """Returns the `InventoryEntry` for the given name, or None."""
+        row = self._connection.execute("SELECT * FROM files WHERE name = ?", (name,)).fetchone()
+        return None if row is None else _parse_row(row)
+
+    def exists(self, name):
+        """
+        Returns True if the given file or directory exists in the snapshot.
+        """
+        directory = name.rstrip("/") + "/"
+        return self._connection.execute(
+            "SELECT 1 FROM files WHERE name = ? OR (name >= ? AND name < ?) LIMIT 1",
+            (name,) + _get_prefix_range(directory),
+        ).fetchone() is not None
+
+    def iter_files(self, prefix="", modified_before=None):
+        """
+        Returns an iterator of `InventoryEntry` for files starting with
+        `prefix`, sorted by name.
+
+        If `modified_before` is given, only files last modified before that
+        (naive UTC) datetime are included.
+        """
+        query = "SELECT * FROM files WHERE name >= ? AND name < ?"
+        params = _get_prefix_range(prefix)
+        if modified_before is not None:
+            query += " AND modified_time < ?"
+            params += (_format_timestamp(modified_before),)
+        for row in self._connection.execute(query + " ORDER BY name", params):
+            yield _parse_row(row)
+
+    def listdir(self, path):
+        """
+        Lists the contents of the specified path, returning a 2-tuple of
+        lists; the first item being directories, the second item being files.
+        """
+        if path and not path.endswith("/"):
+            path += "/"
+        dirs = set()
+        files = []
+        for (name,) in self._connection.execute("SELECT name FROM files WHERE name >= ? AND name < ?", _get_prefix_range(path)):
+            dirname, sep, filename = name[len(path):].partition("/")
+            if sep:
+                dirs.add(dirname)
+            else:
+                files.append(dirname)
+        return list(dirs), files
+
+    def count(self, prefix=""):
+        """Returns the number of files starting with `prefix`."""
+        return self._connection.execute("SELECT COUNT(*) FROM files WHERE name >= ? AND name < ?", _get_prefix_range(prefix)).fetchone()[0]
+
+    def total_size(self, prefix=""):
+        """Returns the total size, in bytes, of files starting with `prefix`."""
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE name >= ? AND name < ?", _get_prefix_range(prefix)).fetchone()[0]
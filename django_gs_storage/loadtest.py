@@ -0,0 +1,248 @@
+from __future__ import unicode_literals
+
+"""
+Load testing of storage throughput.
+"""
+
+import re, random, hashlib, posixpath, threading, uuid
+from collections import defaultdict, Counter
+
+from django.core.files.base import ContentFile
+from django.utils import six
+
+from django_gs_storage.metrics import timer
+
+
+OPERATIONS = ("save", "open", "url", "exists", "delete")
+
+DEFAULT_MIX = "save=2,open=4,url=2,exists=1,delete=1"
+
+SIZE_UNITS = {
+    "": 1,
+    "B": 1,
+    "KB": 1024,
+    "MB": 1024 * 1024,
+    "GB": 1024 * 1024 * 1024,
+}
+
+SIZE_RE = re.compile(r"^(\d+)\s*([KMG]?B?)$", re.IGNORECASE)
+
+
+def parse_mix(value):
+    """
+    Parses an operation mix, such as "save=1,open=4", into a list of
+    (operation, weight) tuples.
+    """
+    mix = []
+    for part in value.split(","):
+        operation, _, weight = part.strip().partition("=")
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown operation \"{}\", expected one of {}".format(operation, ", ".join(OPERATIONS)))
+        try:
+            weight = float(weight or 1)
+        except ValueError:
+            raise ValueError("Invalid weight for {}: \"{}\"".format(operation, weight))
+        if weight > 0:
+            mix.append((operation, weight))
+    if not mix:
+        raise ValueError("The operation mix is empty")
+    return mix
+
+
+def parse_size(value):
+    """Parses a size, such as "64KB", into a number of bytes."""
+    match = SIZE_RE.match(value.strip())
+    if match is None:
+        raise ValueError("Invalid size \"{}\"".format(value))
+    number, unit = match.groups()
+    unit = unit.upper()
+    if unit and not unit.endswith("B"):
+        unit += "B"
+    return int(number) * SIZE_UNITS[unit]
+
+
+RANDOM_BLOCK_SIZE = 1024 * 1024
+
+
+def percentile(samples, percent):
+    """Returns the nearest-rank percentile of the sorted samples."""
+    index = max(int(round(percent / 100.0 * len(samples))) - 1, 0)
+    return samples[index]
+
+
+def random_bytes(size):
+    """
+    Returns incompressible, but reproducible, bytes.
+
+    Larger sizes repeat a 1MB block, which is further apart than gzip can
+    find matches.
+    """
+    chunks = []
+    counter = 0
+    while len(chunks) * 32 < min(size, RANDOM_BLOCK_SIZE):
+        chunks.append(hashlib.sha256(str(counter).encode("ascii")).digest())
+        counter += 1
+    block = b"".join(chunks)
+    return (block * (size // RANDOM_BLOCK_SIZE + 1))[:size]
+
+
+def text_bytes(size):
+    """Returns compressible, reproducible, text."""
+    line = b"The quick brown fox jumps over the lazy dog. 0123456789 {\"key\": \"value\"}\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+class LoadTest(object):
+
+    """
+    Drives a mix of storage operations from several threads, and reports
+    throughput, latency and error rates for each operation.
+
+    Each thread saves `seed_files` files before the test starts, and only
+    opens, checks and deletes files it saved itself. If a thread has no files
+    left, it saves one instead. All files are saved under `prefix`, and
+    removed by `cleanup()`.
+    """
+
+    def __init__(self, storage, threads=4, mix=DEFAULT_MIX, sizes=(1024,), duration=10.0, operations=0, prefix=None, seed_files=10, compressible=False):
+        self.storage = storage
+        self.threads = threads
+        self.mix = parse_mix(mix) if isinstance(mix, six.string_types) else list(mix)
+        self.sizes = list(sizes)
+        self.duration = duration
+        self.operations = operations
+        self.prefix = prefix or posixpath.join("gs_loadtest", uuid.uuid4().hex)
+        self.seed_files = seed_files
+        self.compressible = compressible
+        self._names = []
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def _claim(self):
+        """Returns True if another operation may be started."""
+        if not self.operations:
+            return True
+        with self._lock:
+            if self._count >= self.operations:
+                return False
+            self._count += 1
+            return True
+
+    def _save(self, rng, names, payloads):
+        data = rng.choice(payloads)
+        # Compressible files are saved as text, so they are gzipped.
+        extension = ".txt" if self.compressible else ".bin"
+        names.append(self.storage.save(posixpath.join(self.prefix, uuid.uuid4().hex + extension), ContentFile(data)))
+        return len(data)
+
+    def _run_operation(self, operation, rng, names, payloads):
+        """Runs a single operation, returning the number of payload bytes transferred."""
+        if operation == "save" or not names:
+            return self._save(rng, names, payloads)
+        if operation == "open":
+            with self.storage.open(rng.choice(names)) as handle:
+                return len(handle.read())
+        if operation == "url":
+            self.storage.url(rng.choice(names))
+        elif operation == "exists":
+            self.storage.exists(rng.choice(names))
+        elif operation == "delete":
+            self.storage.delete(names.pop(rng.randrange(len(names))))
+        return 0
+
+    def _work(self, index, deadline, results, payloads):
+        rng = random.Random(index)
+        operations = [operation for operation, weight in self.mix]
+        weights = [weight for operation, weight in self.mix]
+        total_weight = sum(weights)
+        names = self._names[index]
+        samples = defaultdict(list)
+        transferred = Counter()
+        errors = defaultdict(Counter)
+        while timer() < deadline and self._claim():
+            # Pick an operation by weight.
+            point = rng.random() * total_weight
+            for operation, weight in zip(operations, weights):
+                point -= weight
+                if point < 0:
+                    break
+            if not names:
+                operation = "save"
+            start = timer()
+            try:
+                transferred[operation] += self._run_operation(operation, rng, names, payloads)
+            except Exception as ex:
+                errors[operation][ex.__class__.__name__] += 1
+            samples[operation].append(timer() - start)
+        results[index] = (samples, transferred, errors)
+
+    def run(self):
+        """
+        Runs the load test, returning a dict of operation name to statistics,
+        including a "total" for all operations.
+        """
+        payloads = [text_bytes(size) if self.compressible else random_bytes(size) for size in self.sizes]
+        # Seed each thread with files to read.
+        self._names = []
+        for index in range(self.threads):
+            rng = random.Random(-index)
+            names = []
+            for _ in range(self.seed_files):
+                self._save(rng, names, payloads)
+            self._names.append(names)
+        # Run the threads.
+        results = [None] * self.threads
+        start = timer()
+        deadline = start + self.duration
+        threads = [
+            threading.Thread(target=self._work, args=(index, deadline, results, payloads))
+            for index
+            in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = timer() - start
+        # Merge the results.
+        samples = defaultdict(list)
+        transferred = Counter()
+        errors = defaultdict(Counter)
+        for thread_samples, thread_transferred, thread_errors in results:
+            for operation, durations in thread_samples.items():
+                samples[operation].extend(durations)
+                samples["total"].extend(durations)
+            for operation, count in thread_transferred.items():
+                transferred[operation] += count
+                transferred["total"] += count
+            for operation, counts in thread_errors.items():
+                errors[operation].update(counts)
+                errors["total"].update(counts)
+        stats = {}
+        for operation, durations in samples.items():
+            durations.sort()
+            error_count = sum(errors[operation].values())
+            stats[operation] = {
+                "count": len(durations),
+                "errors": error_count,
+                "error_rate": float(error_count) / len(durations),
+                "error_types": dict(errors[operation]),
+                "elapsed": elapsed,
+                "ops_per_sec": len(durations) / elapsed,
+                "bytes_per_sec": transferred[operation] / elapsed,
+                "latency_mean": sum(durations) / len(durations),
+                "latency_p50": percentile(durations, 50),
+                "latency_p90": percentile(durations, 90),
+                "latency_p99": percentile(durations, 99),
+                "latency_max": durations[-1],
+            }
+        return stats
+
+    def cleanup(self):
+        """Deletes the files saved by the load test."""
+        for names in self._names:
+            while names:
+                try:
+                    self.storage.delete(names.pop())
+                except Exception:
+                    pass
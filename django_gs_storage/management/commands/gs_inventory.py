@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from django_gs_storage.inventory import Inventory
+
+
+class Command(BaseCommand):
+
+    help = "Takes an inventory snapshot of GS files into a local SQLite database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("storage_path", help="The path to a storage instance, e.g. path.to.storage.instance")
+        parser.add_argument("inventory_path", help="The local path to write the inventory to.")
+        parser.add_argument("--prefix", default="", help="Only include files starting with this prefix.")
+        parser.add_argument("--no-headers", action="store_false", dest="include_headers", default=True, help="Don't fetch the content type and encoding of each file.")
+
+    def handle(self, storage_path, inventory_path, **kwargs):
+        verbosity = int(kwargs.get("verbosity", 1))
+        # Import the storage.
+        try:
+            storage = import_string(storage_path)
+        except ImportError:
+            raise CommandError("Could not import {}".format(storage_path))
+        # Take the inventory.
+        inventory = Inventory.create(storage, inventory_path, prefix=kwargs["prefix"], include_headers=kwargs["include_headers"])
+        if verbosity >= 1:
+            self.stdout.write("Saved inventory of {count} files ({size} bytes) to {path}".format(
+                count = inventory.count(),
+                size = inventory.total_size(),
+                path = inventory_path,
+            ))
+        inventory.close()
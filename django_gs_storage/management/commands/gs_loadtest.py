@@ -0,0 +1,105 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from django_gs_storage.loadtest import OPERATIONS, DEFAULT_MIX, LoadTest, parse_mix, parse_size
+from django_gs_storage.storage import GSStorage
+from django_gs_storage.testing import FakeGSServer
+
+
+class Command(BaseCommand):
+
+    help = "Measures the throughput, latency and error rate of storage operations."
+
+    def add_arguments(self, parser):
+        parser.add_argument("storage_path", help="The path to a storage instance or class, e.g. path.to.storage.instance")
+        parser.add_argument("--threads", type=int, default=4, help="The number of concurrent threads.")
+        parser.add_argument("--duration", type=float, default=10.0, help="The number of seconds to run for.")
+        parser.add_argument("--operations", type=int, default=0, help="Stop after this many operations.")
+        parser.add_argument("--mix", default=DEFAULT_MIX, help="The weighted mix of operations, e.g. {}".format(DEFAULT_MIX))
+        parser.add_argument("--sizes", default="1KB", help="A comma-separated list of file sizes to save, e.g. 1KB,1MB")
+        parser.add_argument("--compressible", action="store_true", default=False, help="Save compressible text instead of random bytes.")
+        parser.add_argument("--prefix", default=None, help="Save files under this prefix, instead of a random one.")
+        parser.add_argument("--seed-files", type=int, default=10, help="The number of files each thread saves before starting.")
+        parser.add_argument("--keep", action="store_true", default=False, help="Don't delete the saved files afterwards.")
+        parser.add_argument("--output", default=None, help="Also write the results as JSON to this path.")
+        parser.add_argument("--fake-server", action="store_true", default=False, help="Run against a local fake GS server.")
+        parser.add_argument("--latency", type=float, default=0, help="The latency of the fake GS server, in seconds.")
+        parser.add_argument("--bandwidth", type=int, default=None, help="The bandwidth of the fake GS server, in bytes per second.")
+
+    def handle(self, storage_path, **kwargs):
+        verbosity = int(kwargs.get("verbosity", 1))
+        try:
+            mix = parse_mix(kwargs["mix"])
+            sizes = [parse_size(size) for size in kwargs["sizes"].split(",")]
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        # Import the storage.
+        try:
+            storage = import_string(storage_path)
+        except ImportError:
+            raise CommandError("Could not import {}".format(storage_path))
+        if isinstance(storage, type):
+            storage_class, storage_kwargs = storage, {}
+        else:
+            storage_class, storage_kwargs = storage.__class__, None
+        # Run against a fake GS server.
+        server = None
+        if kwargs["fake_server"]:
+            if not issubclass(storage_class, GSStorage):
+                raise CommandError("--fake-server requires a GSStorage, not {}".format(storage_class.__name__))
+            if storage_kwargs is None:
+                storage_kwargs = storage.deconstruct()[2]
+            server = FakeGSServer(latency=kwargs["latency"], bandwidth=kwargs["bandwidth"]).start()
+            storage = storage_class(**dict(storage_kwargs, **server.get_storage_kwargs(
+                gcp_gs_bucket_name = storage_kwargs.get("gcp_gs_bucket_name") or "loadtest",
+            )))
+        elif storage_kwargs is not None:
+            storage = storage_class()
+        # Run the load test.
+        load_test = LoadTest(
+            storage,
+            threads = kwargs["threads"],
+            mix = mix,
+            sizes = sizes,
+            duration = kwargs["duration"],
+            operations = kwargs["operations"],
+            prefix = kwargs["prefix"],
+            seed_files = kwargs["seed_files"],
+            compressible = kwargs["compressible"],
+        )
+        try:
+            if verbosity >= 1:
+                self.stdout.write("Load testing {} with {} threads".format(storage_path, load_test.threads))
+            stats = load_test.run()
+            if not kwargs["keep"]:
+                load_test.cleanup()
+        finally:
+            if server is not None:
+                server.stop()
+        # Report the results.
+        if verbosity >= 1:
+            self.stdout.write("{:<8} {:>8} {:>10} {:>12} {:>9} {:>9} {:>9} {:>8} {:>7}".format(
+                "op", "count", "ops/sec", "bytes/sec", "p50 ms", "p90 ms", "p99 ms", "errors", "error%",
+            ))
+            for operation in OPERATIONS + ("total",):
+                if operation not in stats:
+                    continue
+                op_stats = stats[operation]
+                self.stdout.write("{:<8} {:>8} {:>10.1f} {:>12.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8} {:>7.2f}".format(
+                    operation,
+                    op_stats["count"],
+                    op_stats["ops_per_sec"],
+                    op_stats["bytes_per_sec"],
+                    op_stats["latency_p50"] * 1000,
+                    op_stats["latency_p90"] * 1000,
+                    op_stats["latency_p99"] * 1000,
+                    op_stats["errors"],
+                    op_stats["error_rate"] * 100,
+                ))
+                for error_type, count in sorted(op_stats["error_types"].items()):
+                    self.stdout.write("  {}: {}".format(error_type, count))
+        if kwargs["output"]:
+            with open(kwargs["output"], "w") as handle:
+                json.dump(stats, handle, indent=2, sort_keys=True)
@@ -1,24 +1,38 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.module_loading import import_string
 
+from django_gs_storage.inventory import Inventory
+
 
 class Command(BaseCommand):
 
     help = "Syncronizes the meta information on GS files."
 
-    args = "[path.to.storage.instance, ...]"
+    def add_arguments(self, parser):
+        parser.add_argument("storage_paths", nargs="+", metavar="path.to.storage.instance")
+        parser.add_argument("--inventory", help="Take the files to sync from an inventory created by gs_inventory.")
 
-    def handle(self, *storage_paths, **kwargs):
+    def handle(self, *args, **kwargs):
         verbosity = int(kwargs.get("verbosity", 1))
-        for storage_path in storage_paths:
-            if verbosity >= 1:
-                self.stdout.write("Syncing meta for {}".format(storage_path))
-            # Import the storage.
+        inventory = Inventory(kwargs["inventory"]) if kwargs.get("inventory") else None
+        # Import the storages, checking they match the inventory before syncing any of them.
+        storages = []
+        for storage_path in kwargs["storage_paths"]:
             try:
                 storage = import_string(storage_path)
             except ImportError:
                 raise CommandError("Could not import {}".format(storage_path))
+            if inventory is not None and not inventory.matches(storage):
+                raise CommandError("The inventory of {bucket_name}/{key_prefix} does not match {storage_path}".format(
+                    bucket_name = inventory.bucket_name,
+                    key_prefix = inventory.key_prefix,
+                    storage_path = storage_path,
+                ))
+            storages.append((storage_path, storage))
+        for storage_path, storage in storages:
+            if verbosity >= 1:
+                self.stdout.write("Syncing meta for {}".format(storage_path))
             # Sync the meta.
-            for path in storage.sync_meta_iter():
+            for path in storage.sync_meta_iter(inventory):
                 if verbosity >= 1:
                     self.stdout.write("  Synced meta for {}".format(path))
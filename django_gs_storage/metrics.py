@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+
+"""
+Instrumentation for django-gs-storage.
+
+Storage operations are timed and sent via the `storage_operation` signal. Any
+metrics backend (statsd, Prometheus, logging...) can be plugged in by
+connecting a receiver to the signal.
+"""
+
+import time, threading
+from bisect import bisect_left
+
+from django_gs_storage.signals import storage_operation
+
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+# Histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Measurement(object):
+
+    """
+    Times a single storage operation.
+
+    The `bytes_in` and `bytes_out` counters can be set while the operation
+    runs. The `storage_operation` signal is sent when the operation completes,
+    whether or not it succeeded.
+    """
+
+    __slots__ = ("storage", "operation", "name", "bytes_in", "bytes_out", "start")
+
+    def __init__(self, storage, operation, name):
+        self.storage = storage
+        self.operation = operation
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        storage_operation.send(
+            sender = self.storage.__class__,
+            storage = self.storage,
+            operation = self.operation,
+            name = self.name,
+            duration = timer() - self.start,
+            bytes_in = self.bytes_in,
+            bytes_out = self.bytes_out,
+            error = exc_type is not None,
+        )
+        return False
+
+
+class NullMeasurement(object):
+
+    """
+    A measurement that does nothing, used when instrumentation is disabled.
+    """
+
+    __slots__ = ()
+
+    bytes_in = 0
+
+    bytes_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+null_measurement = NullMeasurement()
+
+
+class OperationStats(object):
+
+    """
+    Aggregated statistics for a single operation type.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, duration, bytes_in, bytes_out, error):
+        self.count += 1
+        self.errors += bool(error)
+        self.duration += duration
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "duration": self.duration,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            # The ratio of output bytes to input bytes. For the compress operation,
+            # this is the compression ratio.
+            "ratio": float(self.bytes_out) / self.bytes_in if self.bytes_in else None,
+            "histogram": list(zip(LATENCY_BUCKETS, self.buckets)),
+        }
+
+
+class MetricsCollector(object):
+
+    """
+    An in-process aggregator for the `storage_operation` signal.
+
+    Keeps per-operation counts, latency histograms and byte counters, which
+    can be exported to a metrics backend via `snapshot()`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, sender, operation, duration, bytes_in, bytes_out, error, **kwargs):
+        with self._lock:
+            try:
+                stats = self._stats[operation]
+            except KeyError:
+                stats = self._stats[operation] = OperationStats()
+            stats.add(duration, bytes_in, bytes_out, error)
+
+    def connect(self, sender=None):
+        storage_operation.connect(self, sender=sender, weak=False, dispatch_uid=id(self))
+
+    def disconnect(self, sender=None):
+        storage_operation.disconnect(self, sender=sender, dispatch_uid=id(self))
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """
+        Returns a dict of operation name to aggregated statistics.
+        """
+        with self._lock:
+            return {
+                operation: stats.as_dict()
+                for operation, stats
+                in self._stats.items()
+            }
@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+"""
+Routing of files to shards, by consistent hashing of their names.
+"""
+
+import hashlib
+from bisect import bisect
+from collections import namedtuple
+
+from django.utils.encoding import force_bytes
+
+
+Shard = namedtuple("Shard", (
+    "name",
+    "bucket",
+    "read_bucket",
+    "prefix",
+    "key_prefix",
+))
+
+
+def _hash(value):
+    return int(hashlib.md5(force_bytes(value)).hexdigest()[:16], 16)
+
+
+def get_prefix_shard_names(count):
+    """
+    Returns the names of `count` hashed key prefixes, as zero-padded hex
+    numbers.
+    """
+    width = len("{:x}".format(max(count - 1, 0)))
+    return ["{:0{width}x}".format(index, width=width) for index in range(count)]
+
+
+class HashRing(object):
+
+    """
+    A consistent hash ring, mapping names to shards.
+
+    Each shard is placed on the ring at `replicas` points, so adding or
+    removing a shard only moves about 1/N of the names.
+    """
+
+    def __init__(self, shards, replicas=100):
+        self.shards = list(shards)
+        points = sorted(
+            (_hash("{}:{}".format(shard.name, replica)), index)
+            for index, shard
+            in enumerate(self.shards)
+            for replica
+            in range(replicas)
+        )
+        self._points = [point for point, index in points]
+        self._indexes = [index for point, index in points]
+
+    def get_shard(self, name):
+        """Returns the shard for the given name."""
+        if len(self.shards) == 1:
+            return self.shards[0]
+        position = bisect(self._points, _hash(name)) % len(self._points)
+        return self.shards[self._indexes[position]]
+
@@ -0,0 +1,17 @@
+"""
+Signals sent by django-gs-storage.
+"""
+
+from django.dispatch import Signal
+
+
+# Sent after every instrumented storage operation, if `GCP_GS_METRICS` is enabled.
+storage_operation = Signal(providing_args=[
+    "storage",
+    "operation",
+    "name",
+    "duration",
+    "bytes_in",
+    "bytes_out",
+    "error",
+])
@@ -1,44 +1,184 @@
 from __future__ import unicode_literals
 
-import posixpath, datetime, mimetypes, gzip, os
+import posixpath, datetime, mimetypes, gzip, os, json, shutil, threading, hashlib, time, logging
 from io import TextIOBase
 from email.utils import parsedate_tz
+from collections import namedtuple, defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 from contextlib import closing, contextmanager
-from tempfile import SpooledTemporaryFile
 
-from boto import gs
-from boto.gs.connection import GSResponseError
+from boto.gs.connection import GSConnection
+from boto.exception import GSResponseError
 
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2.
+    MappingProxyType = dict
+
+try:
+    from functools import lru_cache
+except ImportError:  # Python 2.
+    from django.utils.lru_cache import lru_cache
+
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import Storage
 from django.core.files.base import File
 from django.contrib.staticfiles.storage import ManifestFilesMixin
 from django.utils.deconstruct import deconstructible
 from django.utils import timezone
-from django.utils.encoding import force_bytes, filepath_to_uri
-from django.utils.six.moves.urllib.parse import urljoin
+from django.utils.encoding import filepath_to_uri, force_text
+from django.utils.module_loading import import_string
+from django.utils import six
+from django.utils.six.moves.urllib.parse import urljoin, urlparse
 
+from django_gs_storage.cache import DiskCache
 from django_gs_storage.conf import settings
+from django_gs_storage.files import EncodedTextFile, SpoolBudget, BudgetedSpooledTemporaryFile, MmapFile
+from django_gs_storage.metrics import Measurement, null_measurement
+from django_gs_storage.sharding import Shard, HashRing, get_prefix_shard_names
+from django_gs_storage.writebehind import UploadQueue
+
+
+logger = logging.getLogger(__name__)
 
 
 CONTENT_ENCODING_GZIP = "gzip"
 
 
+STORAGE_CLASS_REDUCED_REDUNDANCY = "DURABLE_REDUCED_AVAILABILITY"
+
+
+# The number of file versions cached for versioned URLs, and how long they
+# are kept for, in case the file is changed by another process.
+VERSION_CACHE_SIZE = 1000
+
+VERSION_CACHE_SECONDS = 60
+
+
+# The directory content-addressed files are saved in, shared by all saves so
+# that identical content is only stored once.
+CONTENT_ADDRESSED_DIRNAME = "cas"
+
+
+StorageConfig = namedtuple("StorageConfig", (
+    "cache_control",
+    "canned_acl",
+    "static_metadata",
+    "callable_metadata",
+    "headers",
+))
+
+
+def _get_extension(name):
+    """
+    Returns the extension of the given file name, as understood by mimetypes.
+
+    Compression suffixes are kept with the preceding extension, so
+    "foo.tar.gz" returns ".tar.gz".
+    """
+    root, extension = posixpath.splitext(posixpath.basename(name))
+    if extension in mimetypes.encodings_map or extension.lower() in mimetypes.encodings_map:
+        extension = posixpath.splitext(root)[1] + extension
+    return extension
+
+
+@lru_cache(maxsize=256)
+def _get_content_type_for_extension(extension):
+    content_type, encoding = mimetypes.guess_type("file" + extension, strict=False)
+    return content_type or "application/octet-stream"
+
+
+def _parse_timestamp(value):
+    """
+    Parses a GS timestamp into a naive UTC datetime.
+
+    HEAD responses use RFC 1123 timestamps, but bucket listings use ISO 8601.
+    """
+    time_tuple = parsedate_tz(value)
+    if time_tuple is None:
+        return datetime.datetime.strptime(value.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S")
+    timestamp = datetime.datetime(*time_tuple[:6])
+    offset = time_tuple[9]
+    if offset is not None:
+        # Convert to local time.
+        timestamp = timezone.make_aware(timestamp, timezone.FixedOffset(offset))
+        timestamp = timezone.make_naive(timestamp, timezone.utc)
+    return timestamp
+
+
+FileStat = namedtuple("FileStat", (
+    "name",
+    "size",
+    "modified_time",
+    "etag",
+    "generation",
+))
+
+
 class GSFile(File):
 
     """
     A file returned from Amazon GS.
+
+    The downloaded content is moved to disk when the file is closed, releasing
+    its share of the spool budget, and kept along with its `etag` and
+    `last_modified` time. Re-opening the file makes a conditional request, and
+    reuses the downloaded content if the file has not changed.
     """
 
     def __init__(self, file, name, storage):
         super(GSFile, self).__init__(file, name)
         self._storage = storage
+        self._raw_file = None
+        self._key = None
+        self._wrappers = []
+        self.etag = None
+        self.last_modified = None
+
+    def _set_raw_file(self, raw_file, key):
+        """
+        Reads this file from the given downloaded file, with the metadata
+        from `key`.
+        """
+        self._raw_file = raw_file
+        self._key = key
+        self._wrappers = self._storage._wrap_raw_file(self.name, raw_file, key.content_encoding)
+        self.file = self._wrappers[-1] if self._wrappers else raw_file
+        self.etag = key.etag
+        self.last_modified = key.last_modified
 
     def open(self, mode=None):
         if self.closed:
-            self.file = self._storage.open(self.name, mode or "rb").file
+            if self._raw_file is None:
+                self.file = self._storage.open(self.name, mode or "rb").file
+            else:
+                raw_file = self._storage._temporary_file(in_memory=not self._storage.gcp_gs_spool_mmap)
+                try:
+                    key = self._storage._fetch(self.name, raw_file, etag=self.etag)
+                except IOError:
+                    raw_file.close()
+                    raise
+                if key is None:
+                    # Not modified, so reuse the downloaded content.
+                    raw_file.close()
+                    self._set_raw_file(self._raw_file, self._key)
+                else:
+                    self._raw_file.close()
+                    self._set_raw_file(raw_file, key)
         return super(GSFile, self).open(mode)
 
+    def close(self):
+        if self._raw_file is None:
+            super(GSFile, self).close()
+            return
+        # Keep the downloaded content, in case the file is re-opened.
+        for wrapper in reversed(self._wrappers):
+            wrapper.close()
+        self._wrappers = []
+        self.file = None
+        self._raw_file.rollover()
+
 
 @deconstructible
 class GSStorage(Storage):
@@ -50,7 +190,7 @@ class GSStorage(Storage):
     Python 3, which is kinda lame.
     """
 
-    def __init__(self, gcp_region=None, gcp_access_key_id=None, gcp_secret_access_key=None, gcp_gs_bucket_name=None, gcp_gs_calling_format=None, gcp_gs_key_prefix=None, gcp_gs_bucket_auth=None, gcp_gs_max_age_seconds=None, gcp_gs_public_url=None, gcp_gs_reduced_redundancy=False, gcp_gs_host=None, gcp_gs_metadata=None, gcp_gs_encrypt_key=None, gcp_gs_gzip=None):
+    def __init__(self, gcp_region=None, gcp_access_key_id=None, gcp_secret_access_key=None, gcp_gs_bucket_name=None, gcp_gs_calling_format=None, gcp_gs_key_prefix=None, gcp_gs_bucket_auth=None, gcp_gs_max_age_seconds=None, gcp_gs_public_url=None, gcp_gs_reduced_redundancy=False, gcp_gs_host=None, gcp_gs_metadata=None, gcp_gs_encrypt_key=None, gcp_gs_gzip=None, gcp_gs_metrics=None, gcp_gs_spool_max_size=None, gcp_gs_spool_max_total_size=None, gcp_gs_spool_dir=None, gcp_gs_spool_mmap=None, gcp_gs_disk_cache_dir=None, gcp_gs_disk_cache_max_size=None, gcp_gs_content_addressed=None, gcp_gs_write_behind_dir=None, gcp_gs_write_behind_workers=None, gcp_gs_write_behind_retries=None, gcp_gs_write_behind_url=None, gcp_gs_bucket_names=None, gcp_gs_key_prefix_shards=None, gcp_gs_read_bucket_names=None, gcp_gs_url_strategy=None, gcp_gs_url_version=None, gcp_gs_cdn_key_name=None, gcp_gs_cdn_key=None):
         self.gcp_region = settings.GCP_REGION if gcp_region is None else gcp_region
         self.gcp_access_key_id = settings.GCP_ACCESS_KEY_ID if gcp_access_key_id is None else gcp_access_key_id
         self.gcp_secret_access_key = settings.GCP_SECRET_ACCESS_KEY if gcp_secret_access_key is None else gcp_secret_access_key
@@ -65,33 +205,179 @@ class GSStorage(Storage):
         self.gcp_gs_metadata = settings.GCP_GS_METADATA if gcp_gs_metadata is None else gcp_gs_metadata
         self.gcp_gs_encrypt_key = settings.GCP_GS_ENCRYPT_KEY if gcp_gs_encrypt_key is None else gcp_gs_encrypt_key
         self.gcp_gs_gzip = settings.GCP_GS_GZIP if gcp_gs_gzip is None else gcp_gs_gzip
+        self.gcp_gs_metrics = settings.GCP_GS_METRICS if gcp_gs_metrics is None else gcp_gs_metrics
+        self.gcp_gs_spool_max_size = settings.GCP_GS_SPOOL_MAX_SIZE if gcp_gs_spool_max_size is None else gcp_gs_spool_max_size
+        self.gcp_gs_spool_max_total_size = settings.GCP_GS_SPOOL_MAX_TOTAL_SIZE if gcp_gs_spool_max_total_size is None else gcp_gs_spool_max_total_size
+        self.gcp_gs_spool_dir = settings.GCP_GS_SPOOL_DIR if gcp_gs_spool_dir is None else gcp_gs_spool_dir
+        self.gcp_gs_spool_mmap = settings.GCP_GS_SPOOL_MMAP if gcp_gs_spool_mmap is None else gcp_gs_spool_mmap
+        self.gcp_gs_disk_cache_dir = settings.GCP_GS_DISK_CACHE_DIR if gcp_gs_disk_cache_dir is None else gcp_gs_disk_cache_dir
+        self.gcp_gs_disk_cache_max_size = settings.GCP_GS_DISK_CACHE_MAX_SIZE if gcp_gs_disk_cache_max_size is None else gcp_gs_disk_cache_max_size
+        self.gcp_gs_content_addressed = settings.GCP_GS_CONTENT_ADDRESSED if gcp_gs_content_addressed is None else gcp_gs_content_addressed
+        self.gcp_gs_write_behind_dir = settings.GCP_GS_WRITE_BEHIND_DIR if gcp_gs_write_behind_dir is None else gcp_gs_write_behind_dir
+        self.gcp_gs_write_behind_workers = settings.GCP_GS_WRITE_BEHIND_WORKERS if gcp_gs_write_behind_workers is None else gcp_gs_write_behind_workers
+        self.gcp_gs_write_behind_retries = settings.GCP_GS_WRITE_BEHIND_RETRIES if gcp_gs_write_behind_retries is None else gcp_gs_write_behind_retries
+        self.gcp_gs_write_behind_url = settings.GCP_GS_WRITE_BEHIND_URL if gcp_gs_write_behind_url is None else gcp_gs_write_behind_url
+        self.gcp_gs_bucket_names = settings.GCP_GS_BUCKET_NAMES if gcp_gs_bucket_names is None else gcp_gs_bucket_names
+        self.gcp_gs_key_prefix_shards = settings.GCP_GS_KEY_PREFIX_SHARDS if gcp_gs_key_prefix_shards is None else gcp_gs_key_prefix_shards
+        self.gcp_gs_read_bucket_names = settings.GCP_GS_READ_BUCKET_NAMES if gcp_gs_read_bucket_names is None else gcp_gs_read_bucket_names
+        self.gcp_gs_url_strategy = settings.GCP_GS_URL_STRATEGY if gcp_gs_url_strategy is None else gcp_gs_url_strategy
+        self.gcp_gs_url_version = settings.GCP_GS_URL_VERSION if gcp_gs_url_version is None else gcp_gs_url_version
+        self.gcp_gs_cdn_key_name = settings.GCP_GS_CDN_KEY_NAME if gcp_gs_cdn_key_name is None else gcp_gs_cdn_key_name
+        self.gcp_gs_cdn_key = settings.GCP_GS_CDN_KEY if gcp_gs_cdn_key is None else gcp_gs_cdn_key
+        url_strategy = self.gcp_gs_url_strategy
+        if isinstance(url_strategy, six.string_types):
+            url_strategy = import_string(url_strategy)
         # Validate args.
-        if self.gcp_gs_public_url and self.gcp_gs_bucket_auth:
+        if self.gcp_gs_public_url and self.gcp_gs_bucket_auth and not url_strategy.serves_private_files:
             raise ImproperlyConfigured("Cannot use GCP_GS_BUCKET_AUTH with GCP_GS_PUBLIC_URL.")
+        if self.gcp_gs_write_behind_dir and self.gcp_gs_content_addressed:
+            raise ImproperlyConfigured("Cannot use GCP_GS_WRITE_BEHIND_DIR with GCP_GS_CONTENT_ADDRESSED.")
+        if self.gcp_gs_public_url and len(self.gcp_gs_bucket_names) > 1:
+            raise ImproperlyConfigured("Cannot use GCP_GS_PUBLIC_URL with multiple GCP_GS_BUCKET_NAMES.")
         # Connect to GS.
         connection_kwargs = {
             "calling_format": self.gcp_gs_calling_format,
         }
         if self.gcp_access_key_id:
-            connection_kwargs["gcp_access_key_id"] = self.gcp_access_key_id
+            connection_kwargs["gs_access_key_id"] = self.gcp_access_key_id
         if self.gcp_secret_access_key:
-            connection_kwargs["gcp_secret_access_key"] = self.gcp_secret_access_key
+            connection_kwargs["gs_secret_access_key"] = self.gcp_secret_access_key
         if self.gcp_gs_host:
-            connection_kwargs["host"] = self.gcp_gs_host
-        self.gs_connection = gs.connect_to_region(self.gcp_region, **connection_kwargs)
+            # The host can optionally include a scheme and port, allowing
+            # connections to a local GS-compatible server.
+            if "://" in self.gcp_gs_host:
+                host_url = urlparse(self.gcp_gs_host)
+                connection_kwargs["host"] = host_url.hostname
+                connection_kwargs["port"] = host_url.port
+                connection_kwargs["is_secure"] = host_url.scheme == "https"
+            else:
+                connection_kwargs["host"] = self.gcp_gs_host
+        self.gs_connection = GSConnection(**connection_kwargs)
         if not self.gcp_gs_bucket_auth:
             self.gs_connection.provider.security_token = ''
-        self.bucket = self.gs_connection.get_bucket(self.gcp_gs_bucket_name, validate=False)
+        # Route files to shards, by bucket and hashed key prefix.
+        bucket_names = self.gcp_gs_bucket_names or [self.gcp_gs_bucket_name]
+        buckets = {}
+        def get_bucket(bucket_name):
+            if bucket_name not in buckets:
+                buckets[bucket_name] = self.gs_connection.get_bucket(bucket_name, validate=False)
+            return buckets[bucket_name]
+        self.shard_ring = HashRing(
+            Shard(
+                name = posixpath.join(bucket_name, prefix),
+                bucket = get_bucket(bucket_name),
+                read_bucket = get_bucket(self.gcp_gs_read_bucket_names.get(bucket_name, bucket_name)),
+                prefix = prefix,
+                key_prefix = posixpath.join(self.gcp_gs_key_prefix, prefix),
+            )
+            for bucket_name
+            in bucket_names
+            for prefix
+            in get_prefix_shard_names(self.gcp_gs_key_prefix_shards) or [""]
+        )
+        self._bucket = get_bucket(bucket_names[0]) if len(bucket_names) == 1 else None
+        # Track memory used by temporary files.
+        self.spool_budget = SpoolBudget(self.gcp_gs_spool_max_total_size)
+        # The upload config is built on first use.
+        self._config = None
+        # Metadata prefetched by stat_batch(), per thread.
+        self._local = threading.local()
+        # File versions for versioned URLs.
+        self._versions = OrderedDict()
+        self._versions_lock = threading.Lock()
+        # Cache opened files on local disk, if required.
+        self.disk_cache = DiskCache(self.gcp_gs_disk_cache_dir, self.gcp_gs_disk_cache_max_size) if self.gcp_gs_disk_cache_dir else None
+        # Upload saved files in the background, if required.
+        self.upload_queue = UploadQueue(self, self.gcp_gs_write_behind_dir, self.gcp_gs_write_behind_workers, self.gcp_gs_write_behind_retries) if self.gcp_gs_write_behind_dir else None
+        # Generate URLs with the configured strategy.
+        self.url_strategy = url_strategy(self)
         # All done!
         super(GSStorage, self).__init__()
 
+    @property
+    def bucket(self):
+        """
+        The GS bucket files are stored in.
+
+        Not available when files are sharded across multiple buckets. Use
+        `_get_shard(name).bucket` instead.
+        """
+        if self._bucket is None:
+            raise ImproperlyConfigured("storage.bucket is not available with multiple GCP_GS_BUCKET_NAMES.")
+        return self._bucket
+
     # Helpers.
 
+    def _measure(self, operation, name):
+        """
+        Returns a context manager that times the given operation.
+
+        If instrumentation is disabled, this is a no-op.
+        """
+        if self.gcp_gs_metrics:
+            return Measurement(self, operation, name)
+        return null_measurement
+
+    def _get_config(self):
+        """
+        Returns the precomputed `StorageConfig` used for uploads.
+
+        The config is built from the storage's own settings, which are fixed
+        when it is created, so it is only built once.
+        """
+        config = self._config
+        if config is None:
+            static_metadata = {}
+            callable_metadata = []
+            for key, value in self.gcp_gs_metadata.items():
+                if callable(value):
+                    callable_metadata.append((key, value))
+                else:
+                    static_metadata[key] = value
+            # Private files served by a CDN can be cached by the CDN.
+            public_cache = not self.gcp_gs_bucket_auth or self.url_strategy.serves_private_files
+            cache_control = "{privacy},max-age={max_age}".format(
+                privacy = "public" if public_cache else "private",
+                max_age = self.gcp_gs_max_age_seconds,
+            )
+            # Versioned public URLs change whenever the file does.
+            if self.gcp_gs_url_version and public_cache:
+                cache_control += ",immutable"
+            # The headers that are the same for every file.
+            headers = {
+                "Cache-Control": cache_control,
+            }
+            headers.update(static_metadata)
+            config = self._config = StorageConfig(
+                cache_control = cache_control,
+                canned_acl = "private" if self.gcp_gs_bucket_auth else "public-read",
+                static_metadata = MappingProxyType(static_metadata),
+                callable_metadata = tuple(callable_metadata),
+                headers = MappingProxyType(headers),
+            )
+        return config
+
+    def _get_headers(self, name, content_type, content_encoding):
+        """
+        Returns the headers for uploading the given file.
+
+        The static headers are copied from a precomputed template, so only
+        callable metadata is evaluated per file.
+        """
+        config = self._get_config()
+        headers = {
+            "Content-Type": content_type,
+        }
+        if content_encoding is not None:
+            headers["Content-Encoding"] = content_encoding
+        headers.update(config.headers)
+        for key, value in config.callable_metadata:
+            headers[key] = value(name)
+        return headers
+
     def _get_content_type(self, name):
         """Calculates the content type of the file from the name."""
-        content_type, encoding = mimetypes.guess_type(name, strict=False)
-        content_type = content_type or "application/octet-stream"
-        return content_type
+        return _get_content_type_for_extension(_get_extension(name))
 
     def _get_cache_control(self):
         """
@@ -100,14 +386,7 @@ class GSStorage(Storage):
         Files in non-authenticated storage get a very long expiry time to
         optimize caching, as well as public caching support.
         """
-        if self.gcp_gs_bucket_auth:
-            privacy = "private"
-        else:
-            privacy = "public"
-        return "{privacy},max-age={max_age}".format(
-            privacy = privacy,
-            max_age = self.gcp_gs_max_age_seconds,
-        )
+        return self._get_config().cache_control
 
     def _get_content_encoding(self, content_type):
         """
@@ -123,61 +402,80 @@ class GSStorage(Storage):
             return CONTENT_ENCODING_GZIP
         return None
 
-    def _temporary_file(self):
+    def _temporary_file(self, in_memory=True):
         """
         Creates a temporary file.
 
-        We need a lot of these, so they are tweaked for efficiency.
+        We need a lot of these, so they are kept in memory up to
+        `gcp_gs_spool_max_size`, as long as the total memory used by temporary
+        files stays below `gcp_gs_spool_max_total_size`.
         """
-        return SpooledTemporaryFile(max_size=1024*1024*10)  # 10 MB.
+        return BudgetedSpooledTemporaryFile(
+            self.spool_budget,
+            max_size = self.gcp_gs_spool_max_size if in_memory else 0,
+            dir = self.gcp_gs_spool_dir or None,
+        )
 
     @contextmanager
     def _conditional_convert_content_to_bytes(self, name, content):
         """
         Forces the given text-mode file into a bytes-mode file.
+
+        The text is encoded lazily as it is read, rather than copied into a
+        temporary file.
         """
         if isinstance(content.file, TextIOBase):
-            with self._temporary_file() as temp_file:
-                for chunk in content.chunks():
-                    temp_file.write(force_bytes(chunk))
-                temp_file.seek(0)
-                yield File(temp_file, name)
+            with closing(EncodedTextFile(content.file)) as bytes_file:
+                yield File(bytes_file, name)
                 return
         yield content
 
     @contextmanager
-    def _conditional_compress_file(self, name, content, content_encoding):
+    def _conditional_compress_file(self, name, content, content_encoding, hasher=None):
         """
         Attempts to compress the given file.
 
         If the file is larger when compressed, returns the original
         file.
 
+        If a `hasher` is given, it is updated with the uncompressed content.
+
         Returns a tuple of (content_encoding, content).
         """
         if self.gcp_gs_gzip and content_encoding == CONTENT_ENCODING_GZIP:
             # Ideally, we would do some sort of incremental compression here,
             # but boto doesn't support uploading a key from an iterator.
             with self._temporary_file() as temp_file:
-                with closing(gzip.GzipFile(name, "wb", 9, temp_file)) as zipfile:
-                    for chunk in content.chunks():
-                        zipfile.write(chunk)
+                with self._measure("compress", name) as measurement:
+                    with closing(gzip.GzipFile(name, "wb", 9, temp_file)) as zipfile:
+                        for chunk in content.chunks():
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            zipfile.write(chunk)
+                    measurement.bytes_in = content.tell()
+                    measurement.bytes_out = temp_file.tell()
                 # Check if the zipped version is actually smaller!
                 if temp_file.tell() < content.tell():
                     temp_file.seek(0)
                     content = File(temp_file, name)
                     yield content, CONTENT_ENCODING_GZIP
                     return
-        # Haha! Gzip made it bigger.
+                # Haha! Gzip made it bigger. At least the content is hashed.
+                hasher = None
+        if hasher is not None:
+            for chunk in content.chunks():
+                hasher.update(chunk)
         content.seek(0)
         yield content, None
 
     @contextmanager
-    def _process_file_for_upload(self, name, content):
+    def _process_file_for_upload(self, name, content, hasher=None):
         """
         For a given filename and file, returns a tuple of
         (content_type, content_encoding, content). The content
         may or may not be the same file as the original.
+
+        If a `hasher` is given, it is updated with the file content.
         """
         # The Django file storage API always rewinds the file before saving,
         # therefor so should we.
@@ -188,20 +486,59 @@ class GSStorage(Storage):
         # Convert files opened in text mode to binary mode.
         with self._conditional_convert_content_to_bytes(name, content) as content:
             # Attempt content compression.
-            with self._conditional_compress_file(name, content, content_encoding) as (content, content_encoding):
+            with self._conditional_compress_file(name, content, content_encoding, hasher) as (content, content_encoding):
                 # Return the calculated headers and file.
                 yield content, content_type, content_encoding,
 
     def get_valid_name(self, name):
         return posixpath.normpath(name.replace(os.sep, "/"))
 
+    def get_available_name(self, name, max_length=None):
+        # Content-addressed names are derived from the file content when
+        # saved, so never clash with a different file.
+        if self.gcp_gs_content_addressed:
+            return name
+        return super(GSStorage, self).get_available_name(name, max_length=max_length)
+
+    def get_content_addressed_name(self, name, digest):
+        """
+        Returns the name to save a file with the given content digest as, in
+        content-addressed mode.
+
+        Files are saved in `CONTENT_ADDRESSED_DIRNAME`, whatever directory
+        `name` is in, keeping the extension of `name`.
+        """
+        return posixpath.join(CONTENT_ADDRESSED_DIRNAME, digest[:32] + _get_extension(posixpath.basename(name)))
+
+    def _get_shard(self, name):
+        """Returns the shard that stores the given file."""
+        return self.shard_ring.get_shard(name)
+
     def _get_key_name(self, name):
         """
         Builds the key name we use to fetch this file form gs
 
         Normalises the path at the end as name can be a relative url
         """
-        return posixpath.join(self.gcp_gs_key_prefix, name)
+        return posixpath.join(self._get_shard(name).key_prefix, name)
+
+    def _get_cache_name(self, name):
+        """Returns the name of the given file in the local disk cache."""
+        shard = self._get_shard(name)
+        return posixpath.join(shard.bucket.name, shard.key_prefix, name)
+
+    def _list(self, prefix="", delimiter="", shards=None):
+        """
+        Returns an iterator of (name, key) for the keys starting with the
+        given prefix, in all shards.
+
+        With a `delimiter`, common prefixes are included, with names ending
+        in the delimiter.
+        """
+        for shard in self.shard_ring.shards if shards is None else shards:
+            root = posixpath.join(shard.key_prefix, "")
+            for key in shard.bucket.list(prefix=root + prefix, delimiter=delimiter):
+                yield key.name[len(root):], key
 
     def _generate_url(self, name):
         """
@@ -210,68 +547,204 @@ class GSStorage(Storage):
         Authenticated storage will return a signed URL. Non-authenticated
         storage will return an unsigned URL, which aids in browser caching.
         """
+        shard = self._get_shard(name)
         return self.gs_connection.generate_url(
             method = "GET",
-            bucket = self.gcp_gs_bucket_name,
-            key = self._get_key_name(name),
+            bucket = shard.bucket.name,
+            key = posixpath.join(shard.key_prefix, name),
             expires_in = self.gcp_gs_max_age_seconds,
             query_auth = self.gcp_gs_bucket_auth,
         )
 
-    def _get_key(self, name, validate=False):
-        return self.bucket.get_key(self._get_key_name(name), validate=validate)
+    def _get_key(self, name, validate=False, read=False):
+        """
+        Returns the key for the given file.
+
+        If `validate` is True, the key metadata is loaded with a HEAD request,
+        and None is returned if the key does not exist.
+
+        If `read` is True, the key is in the read bucket of the file's shard.
+        """
+        shard = self._get_shard(name)
+        key_name = posixpath.join(shard.key_prefix, name)
+        bucket = shard.read_bucket if read else shard.bucket
+        if validate:
+            key = bucket.get_key(key_name)
+            # Read buckets may not have caught up with new files yet.
+            if key is None and bucket is not shard.bucket:
+                key = shard.bucket.get_key(key_name)
+            return key
+        return bucket.new_key(key_name)
 
     def _get_canned_acl(self):
-        return "private" if self.gcp_gs_bucket_auth else "public-read"
+        return self._get_config().canned_acl
 
     def _get_metadata(self, name):
-        return {
-            key: value(name) if callable(value) else value
-            for key, value
-            in self.gcp_gs_metadata.items()
-        }
+        config = self._get_config()
+        metadata = dict(config.static_metadata)
+        for key, value in config.callable_metadata:
+            metadata[key] = value(name)
+        return metadata
+
+    def _fetch(self, name, content, etag=None):
+        """
+        Downloads the raw content of the given file into `content`, returning
+        its key.
+
+        If `etag` is given, a conditional request is made, and None is
+        returned if the file has not changed.
+        """
+        headers = {"If-None-Match": etag} if etag else None
+        key = self._get_key(name, read=True)
+        with self._measure("open", name) as measurement:
+            try:
+                try:
+                    key.get_contents_to_file(content, headers=headers)
+                except GSResponseError as ex:
+                    # Read buckets may not have caught up with new files yet.
+                    if ex.status != 404 or key.bucket is self._get_shard(name).bucket:
+                        raise
+                    key = self._get_key(name)
+                    key.get_contents_to_file(content, headers=headers)
+            except GSResponseError as ex:
+                if etag and ex.status == 304:
+                    return None
+                raise IOError("File {name} does not exist".format(
+                    name = name,
+                ))
+            measurement.bytes_in = content.tell()
+        return key
+
+    def _wrap_raw_file(self, name, raw_file, content_encoding):
+        """
+        Wraps a downloaded file for reading, memory-mapping and un-gzipping it
+        as required.
+
+        Returns a list of the wrapping files, innermost first.
+        """
+        wrappers = []
+        raw_file.seek(0, os.SEEK_END)
+        size = raw_file.tell()
+        raw_file.seek(0)
+        content = raw_file
+        # Memory-map the downloaded file, if required. Empty files cannot be mapped.
+        if self.gcp_gs_spool_mmap and size:
+            content = MmapFile(content, close_file=False)
+            wrappers.append(content)
+        # Un-gzip if required.
+        if content_encoding == CONTENT_ENCODING_GZIP:
+            content = gzip.GzipFile(name, "rb", fileobj=content)
+            wrappers.append(content)
+        return wrappers
+
+    def _open_cached(self, name):
+        """
+        Opens the given file from the local disk cache.
+
+        The cached file is revalidated with a conditional request, and only
+        downloaded if it has changed. Cached files are stored un-gzipped, and
+        memory-mapped when opened.
+
+        Returns None if the cached file was evicted before it could be opened.
+        """
+        cache_name = self._get_cache_name(name)
+        entry = self.disk_cache.get(cache_name)
+        temp_file = self.disk_cache.temporary_file()
+        try:
+            try:
+                key = self._fetch(name, temp_file, etag=entry and entry.etag)
+            except IOError:
+                self.disk_cache.delete(cache_name)
+                raise
+            if key is None:
+                self.disk_cache.touch(entry)
+            else:
+                # Un-gzip into a second temporary file.
+                if key.content_encoding == CONTENT_ENCODING_GZIP:
+                    temp_file.seek(0)
+                    decoded_file = self.disk_cache.temporary_file()
+                    try:
+                        with closing(gzip.GzipFile(name, "rb", fileobj=temp_file)) as zipfile:
+                            shutil.copyfileobj(zipfile, decoded_file)
+                    finally:
+                        temp_file.close()
+                        os.remove(temp_file.name)
+                        temp_file = decoded_file
+                temp_file.close()
+                entry = self.disk_cache.put(cache_name, key.etag, temp_file.name)
+        finally:
+            temp_file.close()
+            if os.path.exists(temp_file.name):
+                os.remove(temp_file.name)
+        try:
+            content = open(entry.path, "rb")
+        except IOError:
+            return None
+        # Empty files cannot be mapped.
+        if os.fstat(content.fileno()).st_size:
+            content = MmapFile(content)
+        return content
 
     def _open(self, name, mode="rb"):
         if mode != "rb":
             raise ValueError("GS files can only be opened in read-only mode")
+        # Files waiting to be uploaded are read from the staging directory.
+        if self.upload_queue is not None:
+            content = self.upload_queue.open(name)
+            if content is not None:
+                return content
+        if self.disk_cache is not None:
+            content = self._open_cached(name)
+            if content is not None:
+                return GSFile(content, name, self)
         # Load the key into a temporary file. It would be nice to stream the
         # content, but GS doesn't support seeking, which is sometimes needed.
-        key = self._get_key(name)
-        content = self._temporary_file()
+        raw_file = self._temporary_file(in_memory=not self.gcp_gs_spool_mmap)
         try:
-            key.get_contents_to_file(content)
-        except GSResponseError:
-            raise IOError("File {name} does not exist".format(
-                name = name,
-            ))
-        content.seek(0)
-        # Un-gzip if required.
-        if key.content_encoding == CONTENT_ENCODING_GZIP:
-            content = gzip.GzipFile(name, "rb", fileobj=content)
+            key = self._fetch(name, raw_file)
+        except IOError:
+            raw_file.close()
+            raise
         # All done!
-        return GSFile(content, name, self)
+        handle = GSFile(None, name, self)
+        handle._set_raw_file(raw_file, key)
+        return handle
 
     def _save(self, name, content):
+        # Normalize relative paths.
+        name = self.get_valid_name(name)
+        # In write-behind mode, the file is uploaded in the background.
+        if self.upload_queue is not None:
+            with self._conditional_convert_content_to_bytes(name, content) as content:
+                return self.upload_queue.put(name, content)
+        return self._upload(name, content)
+
+    def _upload(self, name, content):
+        hasher = hashlib.sha256() if self.gcp_gs_content_addressed else None
         # Calculate the file headers and compression.
-        with self._process_file_for_upload(name, content) as (content, content_type, content_encoding):
+        with self._process_file_for_upload(name, content, hasher) as (content, content_type, content_encoding):
+            # In content-addressed mode, files with identical content are only uploaded once.
+            if hasher is not None:
+                name = self.get_content_addressed_name(name, hasher.hexdigest())
+                with self._measure("exists", name):
+                    key = self._get_key(name, validate=True)
+                if key is not None:
+                    self._cache_version(name, key)
+                    return name
             # Generate file headers.
-            headers = {
-                "Content-Type": content_type,
-                "Cache-Control": self._get_cache_control(),
-            }
-            # Try to compress the file.
-            if content_encoding is not None:
-                headers["Content-Encoding"] = content_encoding
-            # Add additional metadata.
-            headers.update(self._get_metadata(name))
+            headers = self._get_headers(name, content_type, content_encoding)
+            if self.gcp_gs_reduced_redundancy:
+                headers[self.gs_connection.provider.storage_class_header] = STORAGE_CLASS_REDUCED_REDUNDANCY
             # Save the file.
-            self._get_key(name).set_contents_from_file(
-                content,
-                policy = self._get_canned_acl(),
-                headers = headers,
-                reduced_redundancy = self.gcp_gs_reduced_redundancy,
-                encrypt_key = self.gcp_gs_encrypt_key,
-            )
+            with self._measure("save", name) as measurement:
+                key = self._get_key(name)
+                key.set_contents_from_file(
+                    content,
+                    policy = self._get_canned_acl(),
+                    headers = headers,
+                )
+                measurement.bytes_out = key.size or 0
+            self._cache_version(name, key)
             # Return the name that was saved.
             return name
 
@@ -280,55 +753,196 @@ class GSStorage(Storage):
     def delete(self, name):
         """
         Deletes the specified file from the storage system.
+
+        In content-addressed mode, a file can be shared by several saves, so
+        it is not deleted, and a warning is logged.
         """
-        self._get_key(name).delete()
+        if self.gcp_gs_content_addressed:
+            logger.warning("Not deleting %s from GS, as content-addressed files can be shared by several saves", name)
+            return
+        discarded = self.upload_queue is not None and self.upload_queue.discard(name)
+        try:
+            with self._measure("delete", name):
+                self._get_key(name).delete()
+        except GSResponseError as ex:
+            # Files deleted before they were uploaded don't exist in GS.
+            if not (discarded and ex.status == 404):
+                raise
+        if self.disk_cache is not None:
+            self.disk_cache.delete(self._get_cache_name(name))
+        with self._versions_lock:
+            self._versions.pop(name, None)
 
     def exists(self, name):
         """
         Returns True if a file referenced by the given name already exists in the
         storage system, or False if the name is available for a new file.
         """
-        # We also need to check for directory existence, so we'll list matching
-        # keys and return success if any match.
-        for _ in self.bucket.list(prefix=self._get_key_name(name), delimiter="/"):
+        if self.upload_queue is not None and self.upload_queue.get(name) is not None:
             return True
-        return False
+        with self._measure("exists", name):
+            # With several shards, files are checked with a HEAD request to
+            # their own shard, rather than listing every shard.
+            if len(self.shard_ring.shards) > 1 and name and not name.endswith("/"):
+                if self._get_key(name, validate=True) is not None:
+                    return True
+            # We also need to check for directory existence, so we'll list
+            # matching keys and return success if any match. Directories can
+            # span shards, so every shard is listed.
+            dirname = posixpath.join(name, "")
+            for shard in self.shard_ring.shards:
+                for listed_name, _ in self._list(name, delimiter="/", shards=[shard]):
+                    if listed_name == name or listed_name.startswith(dirname):
+                        return True
+                    # Keys are listed in order, so no later key can match.
+                    if listed_name > dirname:
+                        break
+            return False
 
     def listdir(self, path):
         """
         Lists the contents of the specified path, returning a 2-tuple of lists;
         the first item being directories, the second item being files.
         """
-        path = self._get_key_name(path)
         # Normalize directory names.
         if path and not path.endswith("/"):
             path += "/"
-        # Look through the paths, parsing out directories and paths.
+        # Look through the paths in all shards, parsing out directories and paths.
         files = set()
         dirs = set()
-        for key in self.bucket.list(prefix=path, delimiter="/"):
-            key_path = key.name[len(path):]
-            if key_path.endswith("/"):
-                dirs.add(key_path[:-1])
-            else:
-                files.add(key_path)
+        with self._measure("listdir", path):
+            for name, key in self._list(path, delimiter="/"):
+                key_path = name[len(path):]
+                if key_path.endswith("/"):
+                    dirs.add(key_path[:-1])
+                else:
+                    files.add(key_path)
         # All done!
         return list(dirs), list(files)
 
+    def _stat_key(self, name, key):
+        return FileStat(
+            name = name,
+            size = key.size,
+            modified_time = _parse_timestamp(key.last_modified),
+            etag = key.etag,
+            generation = key.generation,
+        )
+
+    def stat_many(self, names, list_threshold=10, max_workers=10):
+        """
+        Returns a dict of name to `FileStat` for the given file names, or
+        None for missing files.
+
+        Names are grouped by directory. Directories containing at least
+        `list_threshold` of the names are listed, and the remaining names are
+        fetched with up to `max_workers` concurrent HEAD requests.
+        """
+        groups = defaultdict(list)
+        for name in names:
+            groups[posixpath.dirname(name)].append(name)
+        stats = {}
+        head_names = []
+        with self._measure("stat_many", ""):
+            for dirname, group in groups.items():
+                if len(group) < list_threshold:
+                    head_names.extend(group)
+                    continue
+                # Only list the shards containing the names.
+                shards = dict(
+                    (shard.name, shard)
+                    for shard
+                    in map(self._get_shard, group)
+                )
+                group_names = set(group)
+                for name, key in self._list(posixpath.join(dirname, ""), delimiter="/", shards=shards.values()):
+                    if name in group_names:
+                        stats[name] = self._stat_key(name, key)
+                for name in group:
+                    stats.setdefault(name, None)
+            if head_names:
+                pool = ThreadPool(min(max_workers, len(head_names)))
+                try:
+                    keys = pool.map(lambda name: self._get_key(name, validate=True, read=True), head_names)
+                finally:
+                    pool.close()
+                for name, key in zip(head_names, keys):
+                    stats[name] = None if key is None else self._stat_key(name, key)
+        return stats
+
+    @contextmanager
+    def stat_batch(self, names, **kwargs):
+        """
+        Prefetches metadata for the given file names with `stat_many()`.
+
+        Inside the block, `size()` and `modified_time()` use the prefetched
+        metadata on the current thread, rather than making a request.
+        """
+        previous = getattr(self._local, "stats", None)
+        stats = dict(previous or ())
+        stats.update(self.stat_many(names, **kwargs))
+        self._local.stats = stats
+        try:
+            yield stats
+        finally:
+            self._local.stats = previous
+
+    def _get_batch_stat(self, name):
+        stats = getattr(self._local, "stats", None)
+        if stats:
+            return stats.get(name)
+        return None
+
+    def _cache_version(self, name, key):
+        if not self.gcp_gs_url_version:
+            return
+        with self._versions_lock:
+            self._versions.pop(name, None)
+            self._versions[name] = (time.time() + VERSION_CACHE_SECONDS, key.etag, key.generation)
+            while len(self._versions) > VERSION_CACHE_SIZE:
+                self._versions.popitem(last=False)
+
+    def _get_version(self, name):
+        """
+        Returns an (etag, generation) tuple for the given file, or None if it
+        is missing.
+
+        Versions are taken from metadata prefetched by `stat_batch()`, or from
+        versions cached when files are saved or looked up. Otherwise, the file
+        metadata is loaded with a HEAD request.
+        """
+        stat = self._get_batch_stat(name)
+        if stat is not None:
+            return stat.etag, stat.generation
+        with self._versions_lock:
+            cached = self._versions.get(name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1:]
+        key = self._get_key(name, validate=True)
+        if key is None:
+            return None
+        self._cache_version(name, key)
+        return key.etag, key.generation
+
     def size(self, name):
         """
         Returns the total size, in bytes, of the file specified by name.
         """
-        return self._get_key(name, validate=True).size
+        stat = self._get_batch_stat(name)
+        if stat is not None:
+            return stat.size
+        with self._measure("size", name):
+            return self._get_key(name, validate=True, read=True).size
 
     def url(self, name):
         """
         Returns an absolute URL where the file's contents can be accessed
         directly by a Web browser.
         """
-        if self.gcp_gs_public_url:
-            return urljoin(self.gcp_gs_public_url, filepath_to_uri(name))
-        return self._generate_url(name)
+        with self._measure("url", name):
+            if self.gcp_gs_write_behind_url and self.upload_queue is not None and self.upload_queue.get(name) is not None:
+                return urljoin(self.gcp_gs_write_behind_url, filepath_to_uri(name))
+            return self.url_strategy.url(name)
 
     def accessed_time(self, name):
         """
@@ -353,54 +967,61 @@ class GSStorage(Storage):
         Returns the last modified time (as datetime object) of the file
         specified by name.
         """
-        time_tuple = parsedate_tz(self._get_key(name, validate=True).last_modified)
-        timestamp = datetime.datetime(*time_tuple[:6])
-        offset = time_tuple[9]
-        if offset is not None:
-            # Convert to local time.
-            timestamp = timezone.make_aware(timestamp, timezone.FixedOffset(offset))
-            timestamp = timezone.make_naive(timestamp, timezone.utc)
-        return timestamp
+        stat = self._get_batch_stat(name)
+        if stat is not None:
+            return stat.modified_time
+        with self._measure("modified_time", name):
+            last_modified = self._get_key(name, validate=True, read=True).last_modified
+        return _parse_timestamp(last_modified)
+
+    def _walk_files(self, root=""):
+        """Returns an iterator of all file paths under the given root."""
+        dirs, files = self.listdir(root)
+        for filename in files:
+            yield posixpath.join(root, filename)
+        for dirname in dirs:
+            for path in self._walk_files(posixpath.join(root, dirname)):
+                yield path
 
-    def sync_meta_iter(self):
+    def sync_meta_iter(self, inventory=None):
         """
         Sycnronizes the meta information on all GS files.
 
+        If an `Inventory` is given, the files to sync are taken from it,
+        rather than listed from GS.
+
         Returns an iterator of paths that have been syncronized.
         """
-        def sync_meta_impl(root):
-            dirs, files = self.listdir(root)
-            for filename in files:
-                path = posixpath.join(root, filename)
-                key = self._get_key(path, validate=True)
-                metadata = key.metadata.copy()
-                metadata["Content-Type"] = key.content_type
-                if key.content_encoding:
-                    metadata["Content-Encoding"] = key.content_encoding
-                metadata["Cache-Control"] = self._get_cache_control()
-                metadata.update(self._get_metadata(path))
-                # Copy the key.
-                key.copy(
-                    key.bucket,
-                    key.name,
-                    preserve_acl=False,
-                    metadata=metadata,
-                    encrypt_key=self.gcp_gs_encrypt_key,
-                )
-                # Set the ACL.
-                key.set_canned_acl(self._get_canned_acl())
-                yield path
-            for dirname in dirs:
-                for path in sync_meta_impl(posixpath.join(root, dirname)):
-                    yield path
-        for path in sync_meta_impl(""):
+        if inventory is None:
+            paths = self._walk_files()
+        else:
+            paths = (entry.name for entry in inventory.iter_files())
+        for path in paths:
+            key = self._get_key(path, validate=True)
+            # Skip files deleted since the inventory was taken.
+            if key is None:
+                continue
+            metadata = key.metadata.copy()
+            metadata.update(self._get_headers(path, key.content_type, key.content_encoding or None))
+            # Copy the key, setting the ACL at the same time.
+            key.bucket.copy_key(
+                key.name,
+                key.bucket.name,
+                key.name,
+                metadata=metadata,
+                preserve_acl=False,
+                encrypt_key=self.gcp_gs_encrypt_key,
+                headers={
+                    self.gs_connection.provider.acl_header: self._get_canned_acl(),
+                },
+            )
             yield path
 
-    def sync_meta(self):
+    def sync_meta(self, inventory=None):
         """
         Sycnronizes the meta information on all GS files.
         """
-        for path in self.sync_meta_iter():
+        for path in self.sync_meta_iter(inventory):
             pass
 
 
@@ -428,9 +1049,218 @@ class StaticGSStorage(GSStorage):
         kwargs.setdefault("gcp_gs_host", settings.GCP_GS_HOST_STATIC)
         kwargs.setdefault("gcp_gs_metadata", settings.GCP_GS_METADATA_STATIC)
         kwargs.setdefault("gcp_gs_gzip", settings.GCP_GS_GZIP_STATIC)
+        # Static files have predictable names, and are uploaded by short-lived processes.
+        kwargs.setdefault("gcp_gs_content_addressed", False)
+        kwargs.setdefault("gcp_gs_write_behind_dir", "")
         super(StaticGSStorage, self).__init__(**kwargs)
 
 
 class ManifestStaticGSStorage(ManifestFilesMixin, StaticGSStorage):
 
-    pass
+    """
+    A GS storage for static files with hashed names, tracked in a manifest.
+
+    A copy of the manifest can be kept in a local file and/or Django cache,
+    saving a download of the manifest in every process. The local copy is
+    checked against the ETag of the remote manifest using a HEAD request,
+    unless `gcp_gs_manifest_verify` is False.
+
+    If `gcp_gs_fast_post_process` is True, `collectstatic` post-processing
+    never reads back from GS. Files are hashed from the local source files,
+    existence is checked against a single bulk listing, and only the final
+    hashed files are uploaded.
+    """
+
+    def __init__(self, gcp_gs_manifest_path=None, gcp_gs_manifest_cache=None, gcp_gs_manifest_verify=None, gcp_gs_fast_post_process=None, **kwargs):
+        self.gcp_gs_manifest_path = settings.GCP_GS_MANIFEST_PATH_STATIC if gcp_gs_manifest_path is None else gcp_gs_manifest_path
+        self.gcp_gs_manifest_cache = settings.GCP_GS_MANIFEST_CACHE_STATIC if gcp_gs_manifest_cache is None else gcp_gs_manifest_cache
+        self.gcp_gs_manifest_verify = settings.GCP_GS_MANIFEST_VERIFY_STATIC if gcp_gs_manifest_verify is None else gcp_gs_manifest_verify
+        self.gcp_gs_fast_post_process = settings.GCP_GS_FAST_POST_PROCESS_STATIC if gcp_gs_fast_post_process is None else gcp_gs_fast_post_process
+        self._post_process_state = None
+        super(ManifestStaticGSStorage, self).__init__(**kwargs)
+
+    # Local manifest copies.
+
+    def _uses_local_manifest(self):
+        return bool(self.gcp_gs_manifest_path or self.gcp_gs_manifest_cache)
+
+    def _get_manifest_cache_key(self):
+        return "django_gs_storage:manifest:{bucket}:{key}".format(
+            bucket = self.gcp_gs_bucket_name,
+            key = self._get_key_name(self.manifest_name),
+        )
+
+    def _get_manifest_etag(self):
+        key = self._get_key(self.manifest_name, validate=True)
+        return None if key is None else key.etag
+
+    def _read_local_manifest(self):
+        """
+        Returns a dict of the locally-stored manifest `etag` and `content`, or
+        None if there is no local copy.
+        """
+        if self.gcp_gs_manifest_cache:
+            stored = caches[self.gcp_gs_manifest_cache].get(self._get_manifest_cache_key())
+            if stored is not None:
+                return stored
+        if self.gcp_gs_manifest_path:
+            try:
+                with open(self.gcp_gs_manifest_path, "r") as handle:
+                    return json.load(handle)
+            except (IOError, ValueError):
+                pass
+        return None
+
+    def _write_local_manifest(self, etag, content):
+        stored = {
+            "etag": etag,
+            "content": content,
+        }
+        if self.gcp_gs_manifest_cache:
+            caches[self.gcp_gs_manifest_cache].set(self._get_manifest_cache_key(), stored, None)
+        if self.gcp_gs_manifest_path:
+            # Write atomically, so concurrent processes never see a partial file.
+            temp_path = "{}.{}.tmp".format(self.gcp_gs_manifest_path, os.getpid())
+            with open(temp_path, "w") as handle:
+                json.dump(stored, handle)
+            os.rename(temp_path, self.gcp_gs_manifest_path)
+
+    # Manifest loading.
+
+    def read_manifest(self):
+        if not self._uses_local_manifest():
+            return super(ManifestStaticGSStorage, self).read_manifest()
+        stored = self._read_local_manifest()
+        if stored is not None and not self.gcp_gs_manifest_verify:
+            return stored["content"]
+        etag = self._get_manifest_etag()
+        if etag is None:
+            return None
+        if stored is not None and stored["etag"] == etag:
+            return stored["content"]
+        # The local copy is missing or stale, so download the manifest.
+        content = super(ManifestStaticGSStorage, self).read_manifest()
+        if content is not None:
+            self._write_local_manifest(etag, content)
+        return content
+
+    def load_manifest(self):
+        # The loaded manifest is only ever replaced, never modified.
+        return MappingProxyType(super(ManifestStaticGSStorage, self).load_manifest())
+
+    # Fast post-processing.
+
+    def _list_all(self):
+        """Returns the set of all file names in the storage, using a single bulk listing."""
+        with self._measure("list", ""):
+            return set(
+                name
+                for name, key
+                in self._list()
+            )
+
+    def _flush_post_process(self):
+        """
+        Uploads the buffered hashed files that are referenced by the manifest,
+        and ends fast post-processing.
+        """
+        state, self._post_process_state = self._post_process_state, None
+        try:
+            for name in set(self.hashed_files.values()):
+                # Hashed files that already exist have identical content.
+                if name in state.pending and name not in state.listing:
+                    temp_file = state.pending[name]
+                    temp_file.seek(0)
+                    self._save(name, File(temp_file, name))
+        finally:
+            state.close()
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not self.gcp_gs_fast_post_process or dry_run:
+            for result in super(ManifestStaticGSStorage, self).post_process(paths, dry_run, **options):
+                yield result
+            return
+        self._post_process_state = _PostProcessState(paths, self._list_all())
+        try:
+            for result in super(ManifestStaticGSStorage, self).post_process(paths, dry_run, **options):
+                yield result
+        finally:
+            if self._post_process_state is not None:
+                self._post_process_state.close()
+                self._post_process_state = None
+
+    def save_manifest(self):
+        # Upload the hashed files before the manifest that references them.
+        if self._post_process_state is not None:
+            self._flush_post_process()
+        super(ManifestStaticGSStorage, self).save_manifest()
+
+    # Storage methods.
+
+    def _open(self, name, mode="rb"):
+        state = self._post_process_state
+        # Read unprocessed files from their local source.
+        if state is not None and name in state.sources and mode == "rb":
+            source_storage, source_path = state.sources[name]
+            return source_storage.open(source_path, mode)
+        return super(ManifestStaticGSStorage, self)._open(name, mode)
+
+    def _save(self, name, content):
+        state = self._post_process_state
+        # Buffer files saved during post-processing.
+        if state is not None:
+            name = self.get_valid_name(name)
+            state.discard(name)
+            content.seek(0)
+            with self._conditional_convert_content_to_bytes(name, content) as content:
+                temp_file = self._temporary_file()
+                for chunk in content.chunks():
+                    temp_file.write(chunk)
+            state.pending[name] = temp_file
+            return name
+        name = super(ManifestStaticGSStorage, self)._save(name, content)
+        # Store a local copy of new manifests.
+        if name == self.manifest_name and self._uses_local_manifest():
+            content.seek(0)
+            self._write_local_manifest(self._get_manifest_etag(), force_text(content.read()))
+        return name
+
+    def delete(self, name):
+        state = self._post_process_state
+        # Hashed files are never deleted from GS during post-processing, as
+        # they will be replaced by a file with identical content.
+        if state is not None:
+            state.discard(name)
+            return
+        super(ManifestStaticGSStorage, self).delete(name)
+
+    def exists(self, name):
+        state = self._post_process_state
+        if state is not None:
+            return name in state.pending or name in state.listing or name in state.sources
+        return super(ManifestStaticGSStorage, self).exists(name)
+
+
+class _PostProcessState(object):
+
+    """
+    The files known to a `ManifestStaticGSStorage` during fast post-processing.
+    """
+
+    def __init__(self, sources, listing):
+        # A dict of name to (storage, path) for the local source files.
+        self.sources = sources
+        # A set of names that exist in GS.
+        self.listing = listing
+        # A dict of name to temporary file for files waiting for upload.
+        self.pending = {}
+
+    def discard(self, name):
+        temp_file = self.pending.pop(name, None)
+        if temp_file is not None:
+            temp_file.close()
+
+    def close(self):
+        for temp_file in self.pending.values():
+            temp_file.close()
+        self.pending.clear()
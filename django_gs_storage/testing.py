@@ -0,0 +1,390 @@
+from __future__ import unicode_literals
+
+"""
+An in-process fake GS server, for hermetic tests and benchmarks.
+
+The server speaks enough of the GS XML API for `GSStorage` to get, put, HEAD,
+list, copy and delete objects, including canned ACLs and range requests.
+Request signatures are not validated, but unsigned requests for private
+objects are rejected, as they would be by GS.
+"""
+
+import re, time, hashlib, threading, datetime
+from collections import defaultdict
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+from django.utils.encoding import force_bytes
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import urlparse, parse_qs, unquote
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+XML_NAMESPACE = "http://doc.s3.amazonaws.com/2006-03-01"
+
+CANNED_ACLS = ("private", "public-read", "public-read-write", "authenticated-read", "bucket-owner-read", "bucket-owner-full-control", "project-private")
+
+# Request headers that are stored alongside an object, and returned with it.
+STORED_HEADERS = ("content-type", "content-encoding", "cache-control", "content-disposition", "content-language", "expires")
+
+META_PREFIX = "x-goog-meta-"
+
+
+class FakeGSObject(object):
+
+    """
+    An object stored in the fake GS server.
+    """
+
+    def __init__(self, data, headers, acl, generation):
+        self.data = data
+        self.headers = headers
+        self.acl = acl
+        self.generation = generation
+        self.etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.last_modified = time.time()
+
+    @property
+    def is_public(self):
+        return self.acl in ("public-read", "public-read-write")
+
+    def get_response_headers(self):
+        headers = {
+            "content-type": "application/octet-stream",
+            "etag": self.etag,
+            "last-modified": formatdate(self.last_modified, usegmt=True),
+            "x-goog-generation": str(self.generation),
+            "x-goog-metageneration": "1",
+            "x-goog-storage-class": "STANDARD",
+        }
+        headers.update(self.headers)
+        return headers
+
+
+class FakeGSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Handles a single request to the fake GS server.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    server_version = "FakeGS"
+
+    # Avoid delayed-ACK stalls on keep-alive connections.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    # Helpers.
+
+    def _parse_request(self):
+        url = urlparse(self.path)
+        self.query = {
+            key: values[0]
+            for key, values
+            in parse_qs(url.query, keep_blank_values=True).items()
+        }
+        path = unquote(url.path).lstrip("/")
+        self.bucket_name, _, self.key_name = path.partition("/")
+        self.fake_server.simulate_latency()
+
+    def _is_authorized(self):
+        if "Authorization" in self.headers:
+            return True
+        if "Signature" in self.query:
+            return int(self.query.get("Expires", 0)) >= time.time()
+        return False
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.fake_server.simulate_transfer(len(body))
+        return body
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.fake_server.simulate_transfer(len(body))
+            self.wfile.write(body)
+
+    def _send_xml(self, status, body, headers=None):
+        headers = dict(headers or {}, **{"Content-Type": "application/xml; charset=UTF-8"})
+        self._send(status, force_bytes("<?xml version='1.0' encoding='UTF-8'?>" + body), headers)
+
+    def _send_error(self, status, code, message):
+        self._send_xml(status, "<Error><Code>{code}</Code><Message>{message}</Message></Error>".format(
+            code = code,
+            message = escape(message),
+        ))
+
+    def _get_object(self):
+        return self.fake_server.buckets[self.bucket_name].get(self.key_name)
+
+    # HTTP methods.
+
+    def do_GET(self):
+        self._parse_request()
+        if not self.key_name:
+            return self._list_objects()
+        obj = self._get_object()
+        if obj is None:
+            return self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+        if not obj.is_public and not self._is_authorized():
+            return self._send_error(403, "AccessDenied", "Access denied.")
+        if "acl" in self.query:
+            return self._get_acl(obj)
+        headers = obj.get_response_headers()
+        if self.headers.get("If-None-Match") == obj.etag:
+            return self._send(304, headers={"ETag": obj.etag})
+        # Handle range requests.
+        data = obj.data
+        range_match = RANGE_RE.match(self.headers.get("Range", ""))
+        if range_match and data:
+            start, end = range_match.groups()
+            if start:
+                start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+            else:
+                start, end = max(len(data) - int(end), 0), len(data) - 1
+            if start >= len(data) or start > end:
+                return self._send_error(416, "InvalidRange", "The requested range cannot be satisfied.")
+            headers["content-range"] = "bytes {}-{}/{}".format(start, end, len(data))
+            return self._send(206, data[start:end + 1], headers)
+        return self._send(200, data, headers)
+
+    def do_HEAD(self):
+        self._parse_request()
+        if not self.key_name:
+            return self._send(200)
+        obj = self._get_object()
+        if obj is None:
+            return self._send(404)
+        if not obj.is_public and not self._is_authorized():
+            return self._send(403)
+        headers = obj.get_response_headers()
+        headers["content-length"] = str(len(obj.data))
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_PUT(self):
+        self._parse_request()
+        body = self._read_body()
+        if not self._is_authorized():
+            return self._send_error(403, "AccessDenied", "Access denied.")
+        if not self.key_name:
+            return self._send(200)
+        if "acl" in self.query:
+            return self._put_acl()
+        copy_source = self.headers.get("x-goog-copy-source")
+        if copy_source:
+            return self._copy_object(copy_source)
+        obj = self.fake_server.put_object(self.bucket_name, self.key_name, body, self._get_stored_headers(), self._get_canned_acl())
+        self._send(200, headers={
+            "ETag": obj.etag,
+            "x-goog-generation": str(obj.generation),
+        })
+
+    def do_DELETE(self):
+        self._parse_request()
+        if not self._is_authorized():
+            return self._send_error(403, "AccessDenied", "Access denied.")
+        with self.fake_server.lock:
+            obj = self.fake_server.buckets[self.bucket_name].pop(self.key_name, None)
+        if obj is None:
+            return self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+        self._send(204)
+
+    # Operations.
+
+    def _get_stored_headers(self):
+        headers = {}
+        for name, value in self.headers.items():
+            name = name.lower()
+            if name in STORED_HEADERS or name.startswith(META_PREFIX):
+                headers[name] = value
+        return headers
+
+    def _get_canned_acl(self):
+        return self.headers.get("x-goog-acl", "project-private")
+
+    def _copy_object(self, copy_source):
+        src_bucket_name, _, src_key_name = unquote(copy_source).lstrip("/").partition("/")
+        src_obj = self.fake_server.buckets[src_bucket_name].get(src_key_name)
+        if src_obj is None:
+            return self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+        if self.headers.get("x-goog-metadata-directive", "COPY").upper() == "REPLACE":
+            headers = self._get_stored_headers()
+        else:
+            headers = src_obj.headers.copy()
+        obj = self.fake_server.put_object(self.bucket_name, self.key_name, src_obj.data, headers, self._get_canned_acl())
+        self._send_xml(200, "<CopyObjectResult><LastModified>{last_modified}</LastModified><ETag>{etag}</ETag></CopyObjectResult>".format(
+            last_modified = format_iso_timestamp(obj.last_modified),
+            etag = escape(obj.etag),
+        ), {
+            "x-goog-generation": str(obj.generation),
+        })
+
+    def _get_acl(self, obj):
+        entries = "<Entry><Scope type='UserById'><ID>fake</ID></Scope><Permission>FULL_CONTROL</Permission></Entry>"
+        if obj.is_public:
+            entries += "<Entry><Scope type='AllUsers'/><Permission>READ</Permission></Entry>"
+        self._send_xml(200, "<AccessControlList><Owner><ID>fake</ID></Owner><Entries>{entries}</Entries></AccessControlList>".format(
+            entries = entries,
+        ))
+
+    def _put_acl(self):
+        obj = self._get_object()
+        if obj is None:
+            return self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+        acl = self._get_canned_acl()
+        if acl not in CANNED_ACLS:
+            return self._send_error(400, "InvalidArgument", "Unsupported ACL.")
+        obj.acl = acl
+        self._send(200)
+
+    def _list_objects(self):
+        if not self._is_authorized():
+            return self._send_error(403, "AccessDenied", "Access denied.")
+        prefix = self.query.get("prefix", "")
+        delimiter = self.query.get("delimiter", "")
+        marker = self.query.get("marker", "")
+        max_keys = int(self.query.get("max-keys", 1000))
+        with self.fake_server.lock:
+            bucket = self.fake_server.buckets[self.bucket_name]
+            names = sorted(name for name in bucket if name.startswith(prefix) and name > marker)
+            objects = {name: bucket[name] for name in names}
+        contents = []
+        common_prefixes = []
+        is_truncated = False
+        last_name = ""
+        for name in names:
+            if len(contents) + len(common_prefixes) >= max_keys:
+                is_truncated = True
+                break
+            if delimiter:
+                index = name.find(delimiter, len(prefix))
+                if index != -1:
+                    common_prefix = name[:index + len(delimiter)]
+                    if common_prefixes and common_prefixes[-1] == common_prefix:
+                        continue
+                    if common_prefix <= marker:
+                        continue
+                    common_prefixes.append(common_prefix)
+                    last_name = common_prefix
+                    continue
+            obj = objects[name]
+            contents.append("<Contents><Key>{name}</Key><Generation>{generation}</Generation><MetaGeneration>1</MetaGeneration><LastModified>{last_modified}</LastModified><ETag>{etag}</ETag><Size>{size}</Size><StorageClass>STANDARD</StorageClass></Contents>".format(
+                name = escape(name),
+                generation = obj.generation,
+                last_modified = format_iso_timestamp(obj.last_modified),
+                etag = escape(obj.etag),
+                size = len(obj.data),
+            ))
+            last_name = name
+        self._send_xml(200, "<ListBucketResult xmlns='{xmlns}'><Name>{bucket}</Name><Prefix>{prefix}</Prefix><Marker>{marker}</Marker>{next_marker}<IsTruncated>{is_truncated}</IsTruncated>{contents}{common_prefixes}</ListBucketResult>".format(
+            xmlns = XML_NAMESPACE,
+            bucket = escape(self.bucket_name),
+            prefix = escape(prefix),
+            marker = escape(marker),
+            next_marker = "<NextMarker>{}</NextMarker>".format(escape(last_name)) if is_truncated else "",
+            is_truncated = "true" if is_truncated else "false",
+            contents = "".join(contents),
+            common_prefixes = "".join(
+                "<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>".format(escape(common_prefix))
+                for common_prefix
+                in common_prefixes
+            ),
+        ))
+
+    @property
+    def fake_server(self):
+        return self.server.fake_server
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeGSServer(object):
+
+    """
+    An in-process fake GS server.
+
+    `latency` is a delay in seconds added to every request. `bandwidth` limits
+    the transfer rate of request and response bodies, in bytes per second.
+
+    Use as a context manager, or call `start()` and `stop()`.
+    """
+
+    access_key_id = "fake-access-key-id"
+
+    secret_access_key = "fake-secret-access-key"
+
+    def __init__(self, latency=0, bandwidth=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.buckets = defaultdict(dict)
+        self._generation = 0
+        self._httpd = ThreadingHTTPServer((host, port), FakeGSRequestHandler)
+        self._httpd.fake_server = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return "http://{}:{}".format(*self._httpd.server_address[:2])
+
+    def get_storage_kwargs(self, **kwargs):
+        """
+        Returns keyword arguments for a `GSStorage` connected to this server.
+        """
+        kwargs.setdefault("gcp_access_key_id", self.access_key_id)
+        kwargs.setdefault("gcp_secret_access_key", self.secret_access_key)
+        kwargs.setdefault("gcp_gs_host", self.host)
+        kwargs.setdefault("gcp_gs_calling_format", "boto.s3.connection.OrdinaryCallingFormat")
+        return kwargs
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def simulate_transfer(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def put_object(self, bucket_name, key_name, data, headers, acl):
+        with self.lock:
+            self._generation += 1
+            obj = FakeGSObject(data, headers, acl, self._generation)
+            self.buckets[bucket_name][key_name] = obj
+            return obj
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def format_iso_timestamp(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"
@@ -1,39 +1,111 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-import posixpath, uuid, datetime, time
+import posixpath, uuid, datetime, time, os, json, shutil, tempfile, hashlib, threading, base64, hmac
+from io import StringIO
 from unittest import skipUnless
 
 import requests
 
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
 from django.core.files.base import ContentFile
-from django.test import TestCase
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import Http404
+from django.test import TestCase, RequestFactory
 from django.utils.encoding import force_bytes, force_text
 from django.utils import timezone
 
+from django_gs_storage.cache import DiskCache
 from django_gs_storage.conf import settings
-from django_gs_storage.storage import GSStorage, StaticGSStorage
+from django_gs_storage.inventory import Inventory
+from django_gs_storage.loadtest import LoadTest, parse_mix, parse_size, percentile, random_bytes, text_bytes
+from django_gs_storage.files import EncodedTextFile, SpoolBudget, BudgetedSpooledTemporaryFile
+from django_gs_storage.metrics import MetricsCollector
+from django_gs_storage.sharding import Shard, HashRing, get_prefix_shard_names
+from django_gs_storage.testing import FakeGSServer
+from django_gs_storage.storage import GSStorage, StaticGSStorage, ManifestStaticGSStorage
+from django_gs_storage.views import serve_staged
+from django_gs_storage.writebehind import UploadQueue
 
 
-@skipUnless(settings.GCP_REGION, "No settings.GCP_REGION supplied.")
-@skipUnless(settings.GCP_ACCESS_KEY_ID, "No settings.GCP_ACCESS_KEY_ID supplied.")
-@skipUnless(settings.GCP_SECRET_ACCESS_KEY, "No settings.GCP_SECRET_ACCESS_KEY supplied.")
-@skipUnless(settings.GCP_GS_BUCKET_NAME, "No settings.GCP_GS_BUCKET_NAME supplied.")
-@skipUnless(settings.GCP_GS_BUCKET_NAME_STATIC, "No settings.GCP_GS_BUCKET_NAME_STATIC supplied.")
 class TestGSStorage(TestCase):
 
-    # Lazy settings tests.
+    """
+    Tests GSStorage against an in-process fake GS server.
+    """
 
-    def testLazySettingsInstanceLookup(self):
-        self.assertTrue(settings.GCP_REGION)
+    # Lazy settings tests.
 
     def testLazySettingsClassLookup(self):
         self.assertEqual(settings.__class__.GCP_REGION.name, "GCP_REGION")
         self.assertEqual(settings.__class__.GCP_REGION.default, "us-east-1")
 
+    def testGetContentType(self):
+        for name, content_type in (
+            ("foo.txt", "text/plain"),
+            ("foo/bar.CSS", "text/css"),
+            ("foo.tar.gz", "application/x-tar"),
+            ("foo.tgz", "application/x-tar"),
+            ("foo.svg.gz", "image/svg+xml"),
+            ("foo.gz", "application/octet-stream"),
+            ("foo.d/bar", "application/octet-stream"),
+            ("foo", "application/octet-stream"),
+        ):
+            self.assertEqual(self.storage._get_content_type(name), content_type)
+
+    def testLazySettingsClearedOnSettingChanged(self):
+        self.assertEqual(settings.GCP_GS_MAX_AGE_SECONDS, 60 * 60)
+        with self.settings(GCP_GS_MAX_AGE_SECONDS=10):
+            self.assertEqual(settings.GCP_GS_MAX_AGE_SECONDS, 10)
+        self.assertEqual(settings.GCP_GS_MAX_AGE_SECONDS, 60 * 60)
+
+    def testConfig(self):
+        storage = self.createStorage(gcp_gs_bucket_auth=False, gcp_gs_max_age_seconds=10, gcp_gs_metadata={
+            "Content-Language": "fr",
+            "Content-Disposition": posixpath.basename,
+        })
+        config = storage._get_config()
+        self.assertEqual(config.cache_control, "public,max-age=10")
+        self.assertEqual(config.canned_acl, "public-read")
+        self.assertEqual(dict(config.static_metadata), {"Content-Language": "fr"})
+        self.assertEqual(storage._get_metadata("foo/bar.txt"), {"Content-Language": "fr", "Content-Disposition": "bar.txt"})
+        self.assertEqual(storage._get_headers("foo/bar.txt", "text/plain", "gzip"), {
+            "Content-Type": "text/plain",
+            "Content-Encoding": "gzip",
+            "Cache-Control": "public,max-age=10",
+            "Content-Language": "fr",
+            "Content-Disposition": "bar.txt",
+        })
+        # The config uses the storage's settings, fixed when it was created.
+        with self.settings(GCP_GS_MAX_AGE_SECONDS=20, GCP_GS_METADATA={"Content-Language": "de"}):
+            self.assertEqual(storage._get_config().cache_control, "public,max-age=10")
+            self.assertEqual(dict(storage._get_config().static_metadata), {"Content-Language": "fr"})
+            # Storages created with changed settings use them.
+            config = self.createStorage(gcp_gs_bucket_auth=False)._get_config()
+            self.assertEqual(config.cache_control, "public,max-age=20")
+            self.assertEqual(dict(config.static_metadata), {"Content-Language": "de"})
+
     # Lifecycle.
 
+    propagation_delay = 0
+
+    @classmethod
+    def startServer(cls):
+        cls.server = FakeGSServer().start()
+        cls.storage_kwargs = cls.server.get_storage_kwargs(gcp_gs_bucket_name="media")
+        cls.static_storage_kwargs = cls.server.get_storage_kwargs(gcp_gs_bucket_name="static")
+
+    @classmethod
+    def stopServer(cls):
+        cls.server.stop()
+
+    @classmethod
+    def createStorage(cls, storage_class=GSStorage, **kwargs):
+        storage_kwargs = cls.static_storage_kwargs if issubclass(storage_class, StaticGSStorage) else cls.storage_kwargs
+        return storage_class(**dict(storage_kwargs, **kwargs))
+
     @classmethod
     def generateUploadBasename(cls, extension=None):
         return uuid.uuid4().hex + (extension or ".txt")
@@ -45,21 +117,22 @@ class TestGSStorage(TestCase):
     @classmethod
     def saveTestFile(cls, upload_path=None, storage=None, file=None):
         saved_path = (storage or cls.storage).save(upload_path or cls.upload_path, file or cls.file)
-        time.sleep(0.2)  # Give it a chance to propagate over GS.
+        time.sleep(cls.propagation_delay)  # Give it a chance to propagate over GS.
         return saved_path
 
     @classmethod
     def setUpClass(cls):
         super(TestGSStorage, cls).setUpClass()
+        cls.startServer()
         cls.key_prefix = uuid.uuid4().hex
-        cls.storage = GSStorage(gcp_gs_key_prefix=cls.key_prefix)
-        cls.storage_metadata = GSStorage(gcp_gs_key_prefix=cls.key_prefix, gcp_gs_metadata={
+        cls.storage = cls.createStorage(gcp_gs_key_prefix=cls.key_prefix)
+        cls.storage_metadata = cls.createStorage(gcp_gs_key_prefix=cls.key_prefix, gcp_gs_metadata={
             "Content-Disposition": lambda name: "attachment;filename={}".format(posixpath.basename(name)),
             "Content-Language": "fr",
         })
-        cls.insecure_storage = GSStorage(gcp_gs_key_prefix=cls.key_prefix, gcp_gs_bucket_auth=False, gcp_gs_max_age_seconds=60*60*24*365)
+        cls.insecure_storage = cls.createStorage(gcp_gs_key_prefix=cls.key_prefix, gcp_gs_bucket_auth=False, gcp_gs_max_age_seconds=60*60*24*365)
         cls.key_prefix_static = uuid.uuid4().hex
-        cls.static_storage = StaticGSStorage(gcp_gs_key_prefix=cls.key_prefix_static)
+        cls.static_storage = cls.createStorage(StaticGSStorage, gcp_gs_key_prefix=cls.key_prefix_static)
         cls.upload_base = uuid.uuid4().hex
         cls.file_contents = force_bytes(uuid.uuid4().hex * 1000, "ascii")
         cls.file = ContentFile(cls.file_contents)
@@ -75,6 +148,7 @@ class TestGSStorage(TestCase):
     def tearDownClass(cls):
         super(TestGSStorage, cls).tearDownClass()
         cls.storage.delete(cls.upload_path)
+        cls.stopServer()
 
     # Assertions.
 
@@ -117,6 +191,58 @@ class TestGSStorage(TestCase):
         handle.open()
         self.assertEqual(handle.read(), self.file_contents)
 
+    def testReOpenUnchanged(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_metrics=True)
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            handle = storage.open(self.upload_path)
+            self.assertTrue(handle.etag)
+            self.assertTrue(handle.last_modified)
+            handle.close()
+            handle.open()
+            self.assertEqual(handle.read(), self.file_contents)
+            handle.close()
+        finally:
+            collector.disconnect()
+        # The second request was conditional, and downloaded nothing.
+        stats = collector.snapshot()
+        self.assertEqual(stats["open"]["count"], 2)
+        self.assertEqual(stats["open"]["bytes_in"], self.storage.size(self.upload_path))
+
+    def testReOpenReleasesSpoolBudget(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix)
+        upload_path = self.generateUploadPath(extension=".jpg")
+        file_contents = self.file_contents * 100
+        storage.save(upload_path, ContentFile(file_contents))
+        try:
+            handle = storage.open(upload_path)
+            self.assertGreater(storage.spool_budget.used, 0)
+            for _ in range(4):
+                self.assertEqual(handle.read(), file_contents)
+                handle.close()
+                # The closed file's content is kept on disk.
+                self.assertEqual(storage.spool_budget.used, 0)
+                handle.open()
+            handle.close()
+        finally:
+            self.storage.delete(upload_path)
+
+    def testReOpenChanged(self):
+        upload_path = self.generateUploadPath()
+        self.saveTestFile(upload_path)
+        try:
+            handle = self.storage.open(upload_path)
+            etag = handle.etag
+            handle.close()
+            self.storage._save(upload_path, ContentFile(b"changed"))
+            handle.open()
+            self.assertEqual(handle.read(), b"changed")
+            self.assertNotEqual(handle.etag, etag)
+            handle.close()
+        finally:
+            self.storage.delete(upload_path)
+
     def testCannotOpenInWriteMode(self):
         with self.assertRaises(ValueError) as cm:
             self.storage.open(self.upload_path, "wb")
@@ -140,12 +266,32 @@ class TestGSStorage(TestCase):
         finally:
             self.storage.delete(upload_path)
 
+    def testSaveLargeTextModeFile(self):
+        file_contents = "Fôö" * 100000
+        for extension in (".txt", ".bin"):
+            upload_path = self.generateUploadPath(extension=extension)
+            self.storage.save(upload_path, ContentFile(file_contents, upload_path))
+            try:
+                stored_contents = self.storage.open(upload_path).read()
+                self.assertEqual(stored_contents, force_bytes(file_contents))
+            finally:
+                self.storage.delete(upload_path)
+
     def testExists(self):
         self.assertTrue(self.storage.exists(self.upload_path))
         self.assertFalse(self.storage.exists(self.generateUploadPath()))
 
     def testDirExists(self):
         self.assertTrue(self.storage.exists(""))
+        self.assertTrue(self.storage.exists(self.upload_dir))
+        self.assertFalse(self.storage.exists(self.upload_dir[:-1]))
+        # Directory names can contain dots.
+        upload_path = posixpath.join(self.upload_dir, "v1.2", "file.txt")
+        self.saveTestFile(upload_path)
+        try:
+            self.assertTrue(self.storage.exists(posixpath.dirname(upload_path)))
+        finally:
+            self.storage.delete(upload_path)
 
     def testDelete(self):
         # Make a new file to delete.
@@ -174,6 +320,32 @@ class TestGSStorage(TestCase):
     def testModifiedTime(self):
         self.assertCorrectTimestamp(self.storage.modified_time(self.upload_path))
 
+    def testStatMany(self):
+        missing_path = self.generateUploadPath()
+        for list_threshold in (1, 100):
+            stats = self.storage.stat_many([self.upload_path, missing_path], list_threshold=list_threshold)
+            self.assertEqual(stats[missing_path], None)
+            stat = stats[self.upload_path]
+            self.assertEqual(stat.name, self.upload_path)
+            self.assertEqual(stat.size, self.storage.size(self.upload_path))
+            self.assertEqual(stat.modified_time, self.storage.modified_time(self.upload_path))
+            self.assertTrue(stat.etag)
+
+    def testStatBatch(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_metrics=True)
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            with storage.stat_batch([self.upload_path]):
+                self.assertEqual(storage.size(self.upload_path), self.storage.size(self.upload_path))
+                self.assertCorrectTimestamp(storage.modified_time(self.upload_path))
+        finally:
+            collector.disconnect()
+        stats = collector.snapshot()
+        self.assertEqual(stats["stat_many"]["count"], 1)
+        self.assertNotIn("size", stats)
+        self.assertNotIn("modified_time", stats)
+
     def testSecureUrlIsAccessible(self):
         # Generate a secure URL.
         url = self.storage.url(self.upload_path)
@@ -237,6 +409,25 @@ class TestGSStorage(TestCase):
             # Clean up the test file.
             self.storage.delete(upload_path)
 
+    def testGzipChunked(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_content_addressed=True)
+        # Larger than the default chunk size, so compressed in several chunks.
+        file_contents = self.file_contents * 1000
+        upload_path = storage.save(self.generateUploadPath(), ContentFile(file_contents))
+        try:
+            self.assertEqual(upload_path, posixpath.join("cas", hashlib.sha256(file_contents).hexdigest()[:32] + ".txt"))
+            self.assertUrlAccessible(storage.url(upload_path), file_contents=file_contents, content_encoding="gzip")
+            self.assertEqual(storage.open(upload_path).read(), file_contents)
+        finally:
+            self.storage.delete(upload_path)
+        # Files that get bigger when gzipped are still uploaded uncompressed.
+        file_contents = os.urandom(2000)
+        upload_path = storage.save(self.generateUploadPath(), ContentFile(file_contents))
+        try:
+            self.assertUrlAccessible(storage.url(upload_path), file_contents=file_contents, content_encoding=None)
+        finally:
+            self.storage.delete(upload_path)
+
     # Uploading with custom metadata.
 
     def testUploadWithMetadata(self):
@@ -272,7 +463,7 @@ class TestGSStorage(TestCase):
         self.assertUrlInaccessible(url)
         # Sync the meta to insecure storage.
         self.insecure_storage.sync_meta()
-        time.sleep(0.2)  # Give it a chance to propagate over GS.
+        time.sleep(self.propagation_delay)  # Give it a chance to propagate over GS.
         # URL is now accessible and well-cached.
         response = self.assertUrlAccessible(url)
         self.assertEqual(response.headers["cache-control"], "public,max-age=31536000")
@@ -285,28 +476,1006 @@ class TestGSStorage(TestCase):
         self.assertEqual(response.headers.get("content-language", ""), "")
         # Sync the meta.
         self.storage_metadata.sync_meta()
-        time.sleep(0.2)  # Give it a chance to propagate over GS.
+        time.sleep(self.propagation_delay)  # Give it a chance to propagate over GS.
         # Metadata should have been synced.
         url = self.storage_metadata.url(self.upload_path)
         response = self.assertUrlAccessible(url)
         self.assertEqual(response.headers["content-disposition"], "attachment;filename={}".format(posixpath.basename(self.upload_path)))
         self.assertEqual(response.headers["content-language"], "fr")
 
+    # Content-addressed storage tests.
+
+    def testContentAddressed(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_content_addressed=True, gcp_gs_metrics=True)
+        upload_path = self.generateUploadPath()
+        self.assertEqual(storage.get_available_name(self.upload_path), self.upload_path)
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            saved_path = storage.save(upload_path, ContentFile(self.file_contents))
+            try:
+                self.assertEqual(posixpath.dirname(saved_path), "cas")
+                self.assertTrue(saved_path.endswith(".txt"))
+                self.assertEqual(storage.open(saved_path).read(), self.file_contents)
+                # Identical content is not uploaded again, even to another directory.
+                self.assertEqual(storage.save(self.generateUploadPath(), ContentFile(self.file_contents)), saved_path)
+                self.assertEqual(storage.save(posixpath.join(self.upload_base, "other.txt"), ContentFile(self.file_contents)), saved_path)
+                # Different content gets a different name.
+                binary_path = storage.save(self.generateUploadPath(extension=".tar.gz"), ContentFile(b"foo"))
+                self.assertNotEqual(binary_path, saved_path)
+                self.assertTrue(binary_path.endswith(".tar.gz"))
+                self.storage.delete(binary_path)
+            finally:
+                self.storage.delete(saved_path)
+        finally:
+            collector.disconnect()
+        self.assertEqual(collector.snapshot()["save"]["count"], 2)
+
+    def testContentAddressedDeleteKeepsSharedFile(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_content_addressed=True)
+        saved_path = storage.save(self.generateUploadPath(), ContentFile(self.file_contents))
+        try:
+            self.assertEqual(storage.save(self.generateUploadPath(), ContentFile(self.file_contents)), saved_path)
+            # Deleting one of the saved files leaves the content for the other.
+            storage.delete(saved_path)
+            self.assertTrue(storage.exists(saved_path))
+            self.assertEqual(storage.open(saved_path).read(), self.file_contents)
+        finally:
+            self.storage.delete(saved_path)
+
+    # Inventory tests.
+
+    def testInventory(self):
+        storage = self.createStorage(gcp_gs_key_prefix=uuid.uuid4().hex)
+        storage._save("foo.txt", ContentFile(self.file_contents))
+        storage._save("bar/baz.jpg", ContentFile(b"baz"))
+        temp_dir = tempfile.mkdtemp()
+        try:
+            inventory = Inventory.create(storage, os.path.join(temp_dir, "inventory.sqlite"))
+            try:
+                self.assertEqual(inventory.count(), 2)
+                self.assertEqual(inventory.total_size(), storage.size("foo.txt") + 3)
+                self.assertEqual(inventory.listdir(""), (["bar"], ["foo.txt"]))
+                self.assertEqual(inventory.listdir("bar"), ([], ["baz.jpg"]))
+                self.assertTrue(inventory.exists("bar"))
+                self.assertTrue(inventory.exists("bar/baz.jpg"))
+                self.assertFalse(inventory.exists("ba"))
+                entry = inventory.get("bar/baz.jpg")
+                self.assertEqual(entry.size, 3)
+                self.assertEqual(entry.modified_time, storage.modified_time("bar/baz.jpg"))
+                self.assertEqual(entry.content_type, "image/jpeg")
+                self.assertEqual(inventory.get("foo.txt").content_encoding, "gzip")
+                self.assertEqual([entry.name for entry in inventory.iter_files("bar/")], ["bar/baz.jpg"])
+                self.assertEqual(list(inventory.iter_files(modified_before=entry.modified_time)), [])
+                self.assertLess(inventory.age, datetime.timedelta(minutes=1))
+                self.assertTrue(inventory.matches(storage))
+                self.assertFalse(inventory.matches(self.storage))
+                with self.assertRaises(CommandError):
+                    call_command("gs_sync_meta", "django.core.files.storage.default_storage", inventory=inventory.path, stdout=StringIO())
+                # The inventory can provide the files to sync.
+                storage.delete("foo.txt")
+                self.assertEqual(list(storage.sync_meta_iter(inventory)), ["bar/baz.jpg"])
+            finally:
+                inventory.close()
+        finally:
+            shutil.rmtree(temp_dir)
+            storage.delete("bar/baz.jpg")
+
+    # Temporary files.
+
+    def testOpenMmap(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_spool_mmap=True)
+        with storage.open(self.upload_path) as handle:
+            self.assertEqual(handle.read(), self.file_contents)
+        handle.open()
+        self.assertEqual(handle.read(), self.file_contents)
+        handle.close()
+        upload_path = self.generateUploadPath(extension=".jpg")
+        self.saveTestFile(upload_path)
+        try:
+            with storage.open(upload_path) as handle:
+                self.assertEqual(handle.read(), self.file_contents)
+                self.assertEqual(handle.size, len(self.file_contents))
+        finally:
+            self.storage.delete(upload_path)
+
+    def testSpoolBudget(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_spool_max_total_size=100)
+        handle = storage.open(self.upload_path)
+        try:
+            self.assertEqual(handle.read(), self.file_contents)
+            self.assertLessEqual(storage.spool_budget.used, 100)
+        finally:
+            handle.close()
+        self.assertEqual(storage.spool_budget.used, 0)
+
+    def testOpenDiskCache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_disk_cache_dir=temp_dir, gcp_gs_metrics=True)
+            upload_path = self.generateUploadPath()
+            self.saveTestFile(upload_path)
+            collector = MetricsCollector()
+            collector.connect()
+            try:
+                for _ in range(3):
+                    with storage.open(upload_path) as handle:
+                        self.assertEqual(handle.read(), self.file_contents)
+                # The file was only downloaded once, and revalidated after that.
+                stats = collector.snapshot()
+                self.assertEqual(stats["open"]["count"], 3)
+                self.assertEqual(stats["open"]["bytes_in"], self.storage.size(upload_path))
+                # Changed files are downloaded again.
+                storage._save(upload_path, ContentFile(b"changed"))
+                with storage.open(upload_path) as handle:
+                    self.assertEqual(handle.read(), b"changed")
+            finally:
+                collector.disconnect()
+                storage.delete(upload_path)
+            # Deleted files are removed from the cache.
+            with self.assertRaises(IOError):
+                storage.open(upload_path)
+            self.assertEqual([filename for dirpath, dirnames, filenames in os.walk(temp_dir) for filename in filenames], [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testWriteBehind(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_write_behind_dir=temp_dir, gcp_gs_write_behind_url="/staged/")
+            upload_path = storage.save(self.generateUploadPath(), ContentFile(self.file_contents))
+            text_path = storage.save(self.generateUploadPath(), ContentFile("Fôö"))
+            try:
+                # The file is available before and after it is uploaded.
+                self.assertTrue(storage.exists(upload_path))
+                self.assertEqual(storage.open(upload_path).read(), self.file_contents)
+                storage.upload_queue.flush()
+                self.assertEqual(storage.upload_queue.depth, 0)
+                self.assertEqual(storage.upload_queue.lag, 0)
+                self.assertEqual(os.listdir(storage.upload_queue.directory), [])
+                self.assertUrlAccessible(storage.url(upload_path))
+                self.assertEqual(self.storage.open(text_path).read(), force_bytes("Fôö"))
+                # Uploaded files are not served.
+                with self.assertRaises(Http404):
+                    serve_staged(RequestFactory().get("/"), upload_path, check_access=lambda request, path: True, storage=storage)
+            finally:
+                storage.delete(upload_path)
+                storage.delete(text_path)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testWriteBehindSharedDirectory(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # Storages in the same process can share a staging directory.
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_write_behind_dir=temp_dir)
+            other_storage = storage.__class__(**storage.deconstruct()[2])
+            self.assertNotEqual(other_storage.upload_queue.directory, storage.upload_queue.directory)
+            upload_path = storage.save(self.generateUploadPath(), ContentFile(self.file_contents))
+            other_upload_path = other_storage.save(self.generateUploadPath(), ContentFile(self.file_contents))
+            try:
+                storage.upload_queue.flush()
+                other_storage.upload_queue.flush()
+                self.assertEqual(self.storage.open(upload_path).read(), self.file_contents)
+                self.assertEqual(self.storage.open(other_upload_path).read(), self.file_contents)
+            finally:
+                storage.delete(upload_path)
+                storage.delete(other_upload_path)
+                storage.upload_queue.close()
+                other_storage.upload_queue.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testCannotUseWriteBehindWithContentAddressed(self):
+        with self.assertRaises(ImproperlyConfigured) as cm:
+            self.createStorage(gcp_gs_write_behind_dir="/tmp", gcp_gs_content_addressed=True)
+        self.assertEqual(force_text(cm.exception), "Cannot use GCP_GS_WRITE_BEHIND_DIR with GCP_GS_CONTENT_ADDRESSED.")
+
+    # Instrumentation.
+
+    def testMetrics(self):
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_metrics=True)
+            upload_path = self.generateUploadPath()
+            self.saveTestFile(upload_path, storage=storage)
+            try:
+                self.assertEqual(storage.open(upload_path).read(), self.file_contents)
+                storage.url(upload_path)
+            finally:
+                storage.delete(upload_path)
+        finally:
+            collector.disconnect()
+        stats = collector.snapshot()
+        self.assertEqual(stats["save"]["count"], 1)
+        self.assertEqual(stats["compress"]["bytes_in"], len(self.file_contents))
+        self.assertLess(stats["compress"]["ratio"], 1)
+        self.assertEqual(stats["open"]["count"], 1)
+        self.assertEqual(stats["open"]["bytes_in"], stats["save"]["bytes_out"])
+        self.assertEqual(stats["url"]["count"], 1)
+        self.assertEqual(stats["delete"]["count"], 1)
+
+    def testMetricsDisabled(self):
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            self.storage.open(self.upload_path).read()
+        finally:
+            collector.disconnect()
+        self.assertEqual(collector.snapshot(), {})
+
     # Public URL tests.
 
     def testCannotUseBucketAuthWithPublicUrl(self):
         with self.assertRaises(ImproperlyConfigured) as cm:
-            GSStorage(gcp_gs_bucket_auth=True, gcp_gs_public_url="http://www.example.com/foo/")
+            self.createStorage(gcp_gs_bucket_auth=True, gcp_gs_public_url="http://www.example.com/foo/")
         self.assertEqual(force_text(cm.exception), "Cannot use GCP_GS_BUCKET_AUTH with GCP_GS_PUBLIC_URL.")
 
     def testGeneratePublicUrl(self):
-        storage = GSStorage(gcp_gs_bucket_auth=False, gcp_gs_public_url="http://www.example.com/foo/")
+        storage = self.createStorage(gcp_gs_bucket_auth=False, gcp_gs_public_url="http://www.example.com/foo/")
         self.assertEqual(storage.url("bar.png"), "http://www.example.com/foo/bar.png")
 
+    # URL strategy tests.
+
+    def testVersionedUrl(self):
+        storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_bucket_auth=False, gcp_gs_url_version="etag")
+        self.assertEqual(storage._get_cache_control(), "public,max-age=3600,immutable")
+        upload_path = self.generateUploadPath()
+        self.saveTestFile(upload_path, storage=storage)
+        try:
+            key = storage._get_key(upload_path, validate=True)
+            # Versions of saved files are cached.
+            storage._get_key = lambda *args, **kwargs: self.fail("File was looked up")
+            url = storage.url(upload_path)
+            self.assertTrue(url.endswith("?v=" + key.etag.strip('"')))
+            self.assertUrlAccessible(url)
+            del storage._get_key
+            # Missing files are not versioned.
+            self.assertNotIn("?", storage.url("missing.txt"))
+            # Prefetched generations are used if available.
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_bucket_auth=False, gcp_gs_public_url="http://www.example.com/", gcp_gs_url_version="generation")
+            with storage.stat_batch([upload_path]):
+                storage._get_key = lambda *args, **kwargs: self.fail("File was looked up")
+                self.assertEqual(storage.url(upload_path), "http://www.example.com/{}?generation={}".format(upload_path, key.generation))
+            del storage._get_key
+            # Looked up versions are cached.
+            storage = self.createStorage(gcp_gs_key_prefix=self.key_prefix, gcp_gs_bucket_auth=False, gcp_gs_url_version="etag")
+            self.assertEqual(storage.url(upload_path), url)
+            storage._get_key = lambda *args, **kwargs: self.fail("File was looked up")
+            self.assertEqual(storage.url(upload_path), url)
+            del storage._get_key
+        finally:
+            storage.delete(upload_path)
+        with self.assertRaises(ImproperlyConfigured):
+            self.createStorage(gcp_gs_url_version="foo")
+
+    def createCdnStorage(self, **kwargs):
+        return self.createStorage(**dict({
+            "gcp_gs_public_url": "https://cdn.example.com/",
+            "gcp_gs_url_strategy": "django_gs_storage.url_strategies.CloudCdnSignedUrlStrategy",
+            "gcp_gs_cdn_key_name": "test-key",
+            "gcp_gs_cdn_key": force_text(base64.urlsafe_b64encode(b"0123456789abcdef")),
+        }, **kwargs))
+
+    def assertCdnSigned(self, value):
+        value, signature = value.rsplit("Signature=", 1)
+        expected = hmac.new(b"0123456789abcdef", force_bytes(value[:-1]), hashlib.sha1).digest()
+        self.assertEqual(base64.urlsafe_b64decode(force_bytes(signature)), expected)
+
+    def testCloudCdnSignedUrl(self):
+        storage = self.createCdnStorage()
+        url = storage.url("foo/bar.png")
+        self.assertTrue(url.startswith("https://cdn.example.com/foo/bar.png?Expires="))
+        self.assertIn("&KeyName=test-key&Signature=", url)
+        self.assertCdnSigned(url)
+        # The URL only changes once per max age.
+        expires = int(url.split("Expires=")[1].split("&")[0])
+        self.assertEqual(expires % 3600, 0)
+        self.assertGreaterEqual(expires, time.time() + 3600)
+        self.assertLessEqual(expires, time.time() + 7200)
+        self.assertEqual(storage.url("foo/bar.png"), url)
+
+    def testCloudCdnSignedCookie(self):
+        storage = self.createCdnStorage(gcp_gs_url_strategy="django_gs_storage.url_strategies.CloudCdnSignedCookieStrategy")
+        self.assertEqual(storage.url("foo/bar.png"), "https://cdn.example.com/foo/bar.png")
+        cookie = storage.url_strategy.get_signed_cookie()
+        self.assertTrue(cookie.startswith("URLPrefix={}:Expires=".format(force_text(base64.urlsafe_b64encode(b"https://cdn.example.com/")))))
+        self.assertIn(":KeyName=test-key:Signature=", cookie)
+        self.assertCdnSigned(cookie)
+
+    def testCloudCdnFilesArePrivate(self):
+        storage = self.createCdnStorage(gcp_gs_key_prefix=self.key_prefix)
+        self.assertTrue(storage.gcp_gs_bucket_auth)
+        self.assertEqual(storage._get_cache_control(), "public,max-age=3600")
+        upload_path = self.generateUploadPath()
+        self.saveTestFile(upload_path, storage=storage)
+        try:
+            # The file can't be read from GS without the CDN.
+            self.assertUrlInaccessible(storage.gs_connection.generate_url(
+                method = "GET",
+                bucket = storage.bucket.name,
+                key = posixpath.join(self.key_prefix, upload_path),
+                expires_in = 0,
+                query_auth = False,
+            ))
+        finally:
+            storage.delete(upload_path)
+
+    def testCloudCdnRequiresKey(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.createCdnStorage(gcp_gs_cdn_key="")
+
     # Static storage tests.
 
     def testStaticGSStorageDefaultsToPublic(self):
         self.assertFalse(self.static_storage.gcp_gs_bucket_auth)
 
+    def testStaticGSStorageIsNotContentAddressed(self):
+        with self.settings(GCP_GS_CONTENT_ADDRESSED=True):
+            self.assertFalse(self.createStorage(StaticGSStorage).gcp_gs_content_addressed)
+
     def testStaticGSStorageDefaultsToLongMaxAge(self):
         self.assertEqual(self.static_storage.gcp_gs_max_age_seconds, 60*60*24*365)
+
+    # Manifest storage tests.
+
+    def createManifestStorage(self, **kwargs):
+        return self.createStorage(ManifestStaticGSStorage, gcp_gs_metrics=True, **kwargs)
+
+    def saveManifest(self, storage, paths):
+        storage.hashed_files = paths
+        storage.save_manifest()
+        time.sleep(self.propagation_delay)
+
+    def assertManifestDownloads(self, count, storage_factory):
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            storage = storage_factory()
+        finally:
+            collector.disconnect()
+        self.assertEqual(collector.snapshot().get("open", {}).get("count", 0), count)
+        return storage
+
+    def testManifestLocalPath(self):
+        key_prefix = uuid.uuid4().hex
+        temp_dir = tempfile.mkdtemp()
+        try:
+            manifest_path = os.path.join(temp_dir, "staticfiles.json")
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_path=manifest_path)
+            self.saveManifest(storage, {"foo.css": "foo.abc123.css"})
+            self.assertTrue(os.path.exists(manifest_path))
+            # The local copy is verified, but not downloaded again.
+            storage = self.assertManifestDownloads(0, lambda: self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_path=manifest_path))
+            self.assertEqual(storage.stored_name("foo.css"), "foo.abc123.css")
+            # A stale local copy is replaced.
+            self.saveManifest(self.createManifestStorage(gcp_gs_key_prefix=key_prefix), {"foo.css": "foo.def456.css"})
+            storage = self.assertManifestDownloads(1, lambda: self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_path=manifest_path))
+            self.assertEqual(storage.stored_name("foo.css"), "foo.def456.css")
+            storage.delete(storage.manifest_name)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testManifestLocalPathUnverified(self):
+        key_prefix = uuid.uuid4().hex
+        temp_dir = tempfile.mkdtemp()
+        try:
+            manifest_path = os.path.join(temp_dir, "staticfiles.json")
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_path=manifest_path)
+            self.saveManifest(storage, {"foo.css": "foo.abc123.css"})
+            storage.delete(storage.manifest_name)
+            # The local copy is trusted without checking GS.
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_path=manifest_path, gcp_gs_manifest_verify=False)
+            self.assertEqual(storage.stored_name("foo.css"), "foo.abc123.css")
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testManifestCache(self):
+        key_prefix = uuid.uuid4().hex
+        storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_cache="default")
+        self.saveManifest(storage, {"foo.css": "foo.abc123.css"})
+        storage = self.assertManifestDownloads(0, lambda: self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_manifest_cache="default"))
+        self.assertEqual(storage.stored_name("foo.css"), "foo.abc123.css")
+        storage.delete(storage.manifest_name)
+
+    def postProcess(self, storage, source_storage):
+        # Mimic collectstatic, which copies the files, then post-processes them.
+        paths = {}
+        for name in sorted(source_storage.listdir("")[1]):
+            with source_storage.open(name) as handle:
+                storage.save(name, handle)
+            paths[name] = (source_storage, name)
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            for name, hashed_name, processed in storage.post_process(paths):
+                if isinstance(processed, Exception):
+                    raise processed
+        finally:
+            collector.disconnect()
+        return collector.snapshot()
+
+    def testManifestFastPostProcess(self):
+        key_prefix = uuid.uuid4().hex
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, "foo.css"), "wb") as handle:
+                handle.write(b"body { background: url('bar.png'); }")
+            with open(os.path.join(temp_dir, "bar.png"), "wb") as handle:
+                handle.write(b"bar")
+            source_storage = FileSystemStorage(location=temp_dir)
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_fast_post_process=True)
+            stats = self.postProcess(storage, source_storage)
+            # Nothing was read back from GS, and only the final files were uploaded.
+            self.assertNotIn("open", stats)
+            self.assertEqual(stats["exists"]["count"], 1)  # Checking for an old manifest.
+            self.assertEqual(stats["list"]["count"], 1)
+            self.assertEqual(stats["save"]["count"], 3)
+            # The manifest and hashed files are correct.
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix)
+            hashed_css = storage.stored_name("foo.css")
+            hashed_png = storage.stored_name("bar.png")
+            self.assertEqual(hashed_png, "bar.37b51d194a75.png")
+            self.assertIn(force_bytes(hashed_png), storage.open(hashed_css).read())
+            self.assertEqual(storage.open(hashed_png).read(), b"bar")
+            # Unchanged files are not uploaded again.
+            storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix, gcp_gs_fast_post_process=True)
+            stats = self.postProcess(storage, source_storage)
+            self.assertEqual(stats["save"]["count"], 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testManifestIsImmutable(self):
+        key_prefix = uuid.uuid4().hex
+        storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix)
+        self.saveManifest(storage, {"foo.css": "foo.abc123.css"})
+        storage = self.createManifestStorage(gcp_gs_key_prefix=key_prefix)
+        with self.assertRaises(TypeError):
+            storage.hashed_files["foo.css"] = "foo.def456.css"
+        storage.delete(storage.manifest_name)
+
+
+class TestEncodedTextFile(TestCase):
+
+    text = "Fôö bär ☃" * 10
+
+    def createFile(self):
+        # A tiny chunk size makes multi-byte characters span chunks.
+        return EncodedTextFile(StringIO(self.text), chunk_size=3)
+
+    def testRead(self):
+        self.assertEqual(self.createFile().read(), force_bytes(self.text))
+
+    def testReadChunks(self):
+        handle = self.createFile()
+        chunks = iter(lambda: handle.read(5), b"")
+        self.assertEqual(b"".join(chunks), force_bytes(self.text))
+
+    def testSeekAndTell(self):
+        handle = self.createFile()
+        size = len(force_bytes(self.text))
+        self.assertEqual(handle.seek(0, os.SEEK_END), size)
+        self.assertEqual(handle.tell(), size)
+        handle.seek(7)
+        self.assertEqual(handle.read(), force_bytes(self.text)[7:])
+        handle.seek(-4, os.SEEK_END)
+        self.assertEqual(handle.read(), force_bytes(self.text)[-4:])
+        handle.seek(0)
+        handle.seek(3, os.SEEK_CUR)
+        self.assertEqual(handle.read(4), force_bytes(self.text)[3:7])
+
+
+class TestBudgetedSpooledTemporaryFile(TestCase):
+
+    def testReservesMemory(self):
+        budget = SpoolBudget(100)
+        with BudgetedSpooledTemporaryFile(budget, max_size=80) as handle:
+            handle.write(b"x" * 50)
+            self.assertFalse(handle._rolled)
+            self.assertEqual(budget.used, 50)
+        self.assertEqual(budget.used, 0)
+
+    def testRollsOverWhenMaxSizeExceeded(self):
+        budget = SpoolBudget(100)
+        with BudgetedSpooledTemporaryFile(budget, max_size=80) as handle:
+            handle.write(b"x" * 50)
+            handle.write(b"x" * 50)
+            self.assertTrue(handle._rolled)
+            self.assertEqual(budget.used, 0)
+            handle.seek(0)
+            self.assertEqual(handle.read(), b"x" * 100)
+
+    def testRollsOverWhenBudgetExceeded(self):
+        budget = SpoolBudget(100)
+        with BudgetedSpooledTemporaryFile(budget, max_size=80) as handle_1:
+            handle_1.write(b"x" * 80)
+            with BudgetedSpooledTemporaryFile(budget, max_size=80) as handle_2:
+                handle_2.write(b"x" * 30)
+                self.assertTrue(handle_2._rolled)
+                self.assertEqual(budget.used, 80)
+            self.assertFalse(handle_1._rolled)
+
+    def testNoMaxSizeUsesDisk(self):
+        budget = SpoolBudget()
+        with BudgetedSpooledTemporaryFile(budget) as handle:
+            self.assertTrue(handle._rolled)
+
+
+class TestDiskCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = DiskCache(os.path.join(self.temp_dir, "cache"), max_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def put(self, name, etag, data):
+        with self.cache.temporary_file() as handle:
+            handle.write(data)
+        return self.cache.put(name, etag, handle.name)
+
+    def testPutAndGet(self):
+        self.assertEqual(self.cache.get("foo"), None)
+        entry = self.put("foo", '"abc"', b"foo")
+        self.assertEqual(self.cache.get("foo"), entry)
+        self.assertEqual(entry.etag, '"abc"')
+        with open(entry.path, "rb") as handle:
+            self.assertEqual(handle.read(), b"foo")
+
+    def testPutReplacesOldVersion(self):
+        self.put("foo", '"abc"', b"foo")
+        entry = self.put("foo", '"def"', b"bar")
+        self.assertEqual(self.cache.get("foo"), entry)
+        self.assertEqual(len(os.listdir(os.path.dirname(entry.path))), 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        entry_1 = self.put("foo", '"1"', b"x" * 40)
+        entry_2 = self.put("bar", '"2"', b"x" * 40)
+        os.utime(entry_1.path, (1, 1))
+        os.utime(entry_2.path, (2, 2))
+        self.put("baz", '"3"', b"x" * 40)
+        self.assertEqual(self.cache.get("foo"), None)
+        self.assertEqual(self.cache.get("bar"), entry_2)
+
+    def testTracksSize(self):
+        self.put("foo", '"1"', b"x" * 40)
+        self.assertEqual(self.cache._size, 40)
+        self.put("bar", '"2"', b"x" * 40)
+        self.put("foo", '"3"', b"x" * 10)
+        self.assertEqual(self.cache._size, 50)
+        self.cache.delete("bar")
+        self.assertEqual(self.cache._size, 10)
+        # The cache is only walked when it grows beyond its maximum size.
+        with open(os.path.join(self.cache.directory, "untracked"), "wb") as handle:
+            handle.write(b"x" * 80)
+        self.put("bar", '"4"', b"x" * 10)
+        self.assertEqual(self.cache._size, 20)
+        self.put("baz", '"5"', b"x" * 90)
+        self.assertLessEqual(self.cache._size, 90)
+
+
+class UploadQueueStorage(object):
+
+    """
+    Records uploads from an `UploadQueue`, failing and blocking on request.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.uploaded = []
+        self.deleted = []
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+
+    def _get_content_type(self, name):
+        return "text/plain"
+
+    def _upload(self, name, content):
+        self.unblocked.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Upload failed")
+        self.uploaded.append((name, content.read()))
+        return name
+
+    def url(self, name):
+        return "http://www.example.com/" + name
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+
+class TestUploadQueue(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def createQueue(self, storage, **kwargs):
+        storage.upload_queue = UploadQueue(storage, self.temp_dir, retry_delay=0, **kwargs)
+        self.addCleanup(storage.upload_queue.close)
+        return storage.upload_queue
+
+    def testStagedUntilUploaded(self):
+        storage = UploadQueueStorage()
+        storage.unblocked.clear()
+        upload_queue = self.createQueue(storage)
+        self.assertEqual(upload_queue.put("foo.txt", ContentFile(b"foo")), "foo.txt")
+        self.assertEqual(upload_queue.depth, 1)
+        self.assertGreaterEqual(upload_queue.lag, 0)
+        self.assertEqual(upload_queue.open("foo.txt").read(), b"foo")
+        response = serve_staged(RequestFactory().get("/"), "foo.txt", check_access=lambda request, path: True, storage=storage)
+        self.assertEqual(b"".join(response.streaming_content), b"foo")
+        self.assertEqual(response["Content-Type"], "text/plain")
+        with self.assertRaises(PermissionDenied):
+            serve_staged(RequestFactory().get("/"), "foo.txt", check_access=lambda request, path: False, storage=storage)
+        with self.assertRaises(Http404):
+            serve_staged(RequestFactory().get("/"), "bar.txt", check_access=lambda request, path: True, storage=storage)
+        storage.unblocked.set()
+        upload_queue.flush()
+        self.assertEqual(storage.uploaded, [("foo.txt", b"foo")])
+        self.assertEqual(upload_queue.depth, 0)
+        self.assertEqual(upload_queue.open("foo.txt"), None)
+        self.assertEqual(os.listdir(upload_queue.directory), [])
+
+    def testSavedAgain(self):
+        storage = UploadQueueStorage()
+        storage.unblocked.clear()
+        upload_queue = self.createQueue(storage)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        upload_queue.put("foo.txt", ContentFile(b"bar"))
+        self.assertEqual(upload_queue.open("foo.txt").read(), b"bar")
+        storage.unblocked.set()
+        upload_queue.flush()
+        self.assertEqual(storage.uploaded[-1], ("foo.txt", b"bar"))
+        self.assertEqual(storage.deleted, [])
+        self.assertEqual(os.listdir(upload_queue.directory), [])
+
+    def testDiscard(self):
+        storage = UploadQueueStorage()
+        storage.unblocked.clear()
+        upload_queue = self.createQueue(storage)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        self.assertTrue(upload_queue.discard("foo.txt"))
+        self.assertFalse(upload_queue.discard("foo.txt"))
+        storage.unblocked.set()
+        upload_queue.flush()
+        # Files already being uploaded are deleted afterwards.
+        self.assertEqual(storage.deleted, [name for name, data in storage.uploaded])
+        self.assertEqual(os.listdir(upload_queue.directory), [])
+
+    def testSharedIndex(self):
+        storage = UploadQueueStorage()
+        storage.unblocked.clear()
+        upload_queue = self.createQueue(storage)
+        other_storage = UploadQueueStorage()
+        other_queue = self.createQueue(other_storage)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        upload_queue.put("bar.txt", ContentFile(b"bar"))
+        # Files staged by another queue are visible.
+        self.assertEqual(other_queue.open("foo.txt").read(), b"foo")
+        self.assertEqual(other_queue.depth, 0)
+        # Files can be discarded by another queue.
+        self.assertTrue(other_queue.discard("foo.txt"))
+        self.assertEqual(upload_queue.get("foo.txt"), None)
+        storage.unblocked.set()
+        upload_queue.flush()
+        self.assertEqual(sorted(storage.deleted), sorted(name for name, data in storage.uploaded if name == "foo.txt"))
+        self.assertIn(("bar.txt", b"bar"), storage.uploaded)
+        self.assertEqual(other_queue.get("bar.txt"), None)
+        self.assertEqual(upload_queue.depth, 0)
+
+    def testRetries(self):
+        storage = UploadQueueStorage(failures=2)
+        upload_queue = self.createQueue(storage, retries=2)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        upload_queue.flush()
+        self.assertEqual(storage.uploaded, [("foo.txt", b"foo")])
+
+    def testFailedUploadsRecovered(self):
+        upload_queue = self.createQueue(UploadQueueStorage(failures=1), retries=0)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        upload_queue.flush()
+        self.assertEqual(upload_queue.failed, 1)
+        self.assertEqual(upload_queue.open("foo.txt").read(), b"foo")
+        upload_queue.close()
+        # The next queue using the staging directory uploads the file.
+        storage = UploadQueueStorage()
+        upload_queue = self.createQueue(storage)
+        upload_queue.flush()
+        self.assertEqual(storage.uploaded, [("foo.txt", b"foo")])
+        self.assertEqual(os.listdir(upload_queue.directory), [])
+
+    def testExitedProcessesRecovered(self):
+        import fcntl
+        upload_queue = self.createQueue(UploadQueueStorage(failures=1), retries=0)
+        upload_queue.put("foo.txt", ContentFile(b"foo"))
+        upload_queue.close()
+        # Pretend the files were staged by exited and running processes.
+        exited_directory = "{}-{}".format(upload_queue.directory.rsplit("-", 1)[0], 2 ** 31)
+        running_directory = exited_directory + "1"
+        os.rename(upload_queue.directory, exited_directory)
+        os.rename(upload_queue.directory + ".lock", exited_directory + ".lock")
+        os.mkdir(running_directory)
+        with open(os.path.join(running_directory, "00000000000000000000-running"), "wb") as handle:
+            handle.write(b"bar")
+        with open(os.path.join(running_directory, "00000000000000000000-running.json"), "w") as handle:
+            json.dump({"name": "bar.txt", "queued_time": time.time()}, handle)
+        running_lock_fd = os.open(running_directory + ".lock", os.O_RDWR | os.O_CREAT)
+        fcntl.flock(running_lock_fd, fcntl.LOCK_EX)
+        try:
+            storage = UploadQueueStorage()
+            upload_queue = self.createQueue(storage)
+            upload_queue.flush()
+        finally:
+            os.close(running_lock_fd)
+        # Only the exited process's files are uploaded.
+        self.assertEqual(storage.uploaded, [("foo.txt", b"foo")])
+        self.assertFalse(os.path.exists(exited_directory))
+        self.assertFalse(os.path.exists(exited_directory + ".lock"))
+        self.assertEqual(len(os.listdir(running_directory)), 2)
+
+    @skipUnless(hasattr(os, "fork"), "Requires os.fork().")
+    def testFork(self):
+        storage = UploadQueueStorage()
+        upload_queue = self.createQueue(storage)
+        parent_directory = upload_queue.directory
+        pid = os.fork()
+        if pid == 0:
+            try:
+                upload_queue.put("foo.txt", ContentFile(b"foo"))
+                upload_queue.flush()
+                os._exit(0 if storage.uploaded == [("foo.txt", b"foo")] and upload_queue.directory != parent_directory else 1)
+            finally:
+                os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        # The child staged files in its own directory.
+        child_prefix = "{}-{}-".format(parent_directory.rsplit("-", 2)[0], pid)
+        child_directories = [
+            os.path.join(self.temp_dir, name)
+            for name in os.listdir(self.temp_dir)
+            if os.path.join(self.temp_dir, name).startswith(child_prefix) and not name.endswith(".lock")
+        ]
+        self.assertEqual(len(child_directories), 1)
+        self.assertEqual(os.listdir(child_directories[0]), [])
+
+
+class TestFakeGSServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestFakeGSServer, cls).setUpClass()
+        cls.server = FakeGSServer().start()
+        cls.storage = GSStorage(**cls.server.get_storage_kwargs(gcp_gs_bucket_name="media", gcp_gs_gzip=False))
+        cls.file_contents = force_bytes(uuid.uuid4().hex * 100, "ascii")
+        cls.storage.save("test.txt", ContentFile(cls.file_contents))
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestFakeGSServer, cls).tearDownClass()
+        cls.server.stop()
+
+    def testRangeRequest(self):
+        key = self.storage._get_key("test.txt")
+        self.assertEqual(key.get_contents_as_string(headers={"Range": "bytes=10-19"}), self.file_contents[10:20])
+        self.assertEqual(key.size, len(self.file_contents))
+
+    def testCopy(self):
+        self.storage.bucket.copy_key("copy.txt", "media", "test.txt")
+        try:
+            self.assertEqual(self.storage.open("copy.txt").read(), self.file_contents)
+        finally:
+            self.storage.delete("copy.txt")
+
+    def testLatency(self):
+        self.server.latency = 0.1
+        try:
+            start = time.time()
+            self.storage.exists("test.txt")
+            self.assertGreaterEqual(time.time() - start, 0.1)
+        finally:
+            self.server.latency = 0
+
+    def testBandwidth(self):
+        self.server.bandwidth = len(self.file_contents) * 10
+        try:
+            start = time.time()
+            self.storage.open("test.txt").read()
+            self.assertGreaterEqual(time.time() - start, 0.1)
+        finally:
+            self.server.bandwidth = None
+
+
+class TestLoadTest(TestCase):
+
+    def testParse(self):
+        self.assertEqual(parse_mix("save=2,open,delete=0"), [("save", 2.0), ("open", 1.0)])
+        self.assertEqual([parse_size(size) for size in ("10", "10B", "1k", "64KB", "2MB")], [10, 10, 1024, 65536, 2097152])
+        self.assertRaises(ValueError, parse_mix, "copy=1")
+        self.assertRaises(ValueError, parse_mix, "save=lots")
+        self.assertRaises(ValueError, parse_mix, "save=0")
+        self.assertRaises(ValueError, parse_size, "1TB")
+
+    def testPayloads(self):
+        self.assertEqual(random_bytes(3 * 1024 * 1024), random_bytes(3 * 1024 * 1024))
+        self.assertEqual(len(random_bytes(100)), 100)
+        self.assertEqual(len(text_bytes(100)), 100)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+
+    def testLoadTest(self):
+        with FakeGSServer() as server:
+            storage = GSStorage(**server.get_storage_kwargs(gcp_gs_bucket_name="loadtest"))
+            load_test = LoadTest(storage, threads=2, sizes=(100, 1000), operations=50, seed_files=2)
+            stats = load_test.run()
+            self.assertEqual(stats["total"]["count"], 50)
+            self.assertEqual(stats["total"]["errors"], 0)
+            self.assertEqual(sum(stats[operation]["count"] for operation in stats if operation != "total"), 50)
+            self.assertGreater(stats["open"]["bytes_per_sec"], 0)
+            self.assertLessEqual(stats["total"]["latency_p50"], stats["total"]["latency_p99"])
+            self.assertTrue(server.buckets["loadtest"])
+            load_test.cleanup()
+            self.assertFalse(server.buckets["loadtest"])
+            # Compressible files are gzipped.
+            load_test = LoadTest(storage, threads=1, mix=parse_mix("save=1"), sizes=(1000,), operations=5, seed_files=1, compressible=True)
+            load_test.run()
+            self.assertEqual(set(obj.headers.get("content-encoding") for obj in server.buckets["loadtest"].values()), set(["gzip"]))
+            load_test.cleanup()
+
+    def testCommand(self):
+        stdout = StringIO()
+        call_command("gs_loadtest", "django_gs_storage.storage.GSStorage", "--fake-server", "--operations=20", "--threads=2", "--sizes=1KB,4KB", stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("ops/sec", output)
+        self.assertIn("total", output)
+        self.assertRaises(CommandError, call_command, "gs_loadtest", "django_gs_storage.storage.GSStorage", "--mix=copy=1")
+        self.assertRaises(CommandError, call_command, "gs_loadtest", "django.core.files.storage.FileSystemStorage", "--fake-server")
+
+
+class TestShardedGSStorage(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestShardedGSStorage, cls).setUpClass()
+        cls.server = FakeGSServer().start()
+        cls.storage = GSStorage(**cls.server.get_storage_kwargs(
+            gcp_gs_bucket_name = "media",
+            gcp_gs_bucket_names = ["media", "media-2"],
+            gcp_gs_key_prefix = "files",
+            gcp_gs_key_prefix_shards = 4,
+            gcp_gs_read_bucket_names = {"media": "media-replica"},
+        ))
+        cls.names = ["foo/{}.txt".format(index) for index in range(20)]
+        for name in cls.names:
+            cls.storage.save(name, ContentFile(force_bytes(name)))
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestShardedGSStorage, cls).tearDownClass()
+        cls.server.stop()
+
+    def testHashRing(self):
+        shards = [Shard(name, None, None, "", "") for name in ("a", "b", "c")]
+        names = [uuid.uuid4().hex for _ in range(1000)]
+        ring = HashRing(shards)
+        assignments = {name: ring.get_shard(name).name for name in names}
+        self.assertEqual(set(assignments.values()), set(["a", "b", "c"]))
+        # Adding a shard only moves names to the new shard.
+        ring = HashRing(shards + [Shard("d", None, None, "", "")])
+        for name in names:
+            self.assertIn(ring.get_shard(name).name, (assignments[name], "d"))
+
+    def testPrefixShardNames(self):
+        self.assertEqual(get_prefix_shard_names(4), ["0", "1", "2", "3"])
+        self.assertEqual(get_prefix_shard_names(16)[-1], "f")
+        self.assertEqual(get_prefix_shard_names(17)[-1], "10")
+
+    def testFilesAreSharded(self):
+        stored = set(
+            (bucket_name, key_name.split("/")[1])
+            for bucket_name in ("media", "media-2")
+            for key_name in self.server.buckets[bucket_name]
+        )
+        self.assertGreater(len(stored), 4)
+        for name in self.names:
+            shard = self.storage._get_shard(name)
+            self.assertIn(posixpath.join("files", shard.prefix, name), self.server.buckets[shard.bucket.name])
+
+    def testListdir(self):
+        self.assertEqual(self.storage.listdir(""), (["foo"], []))
+        self.assertEqual(sorted(self.storage.listdir("foo")[1]), sorted(posixpath.basename(name) for name in self.names))
+
+    def testExists(self):
+        self.assertTrue(self.storage.exists("foo"))
+        self.assertTrue(self.storage.exists("foo/"))
+        self.assertFalse(self.storage.exists("fo"))
+        self.assertTrue(self.storage.exists(self.names[0]))
+        self.assertFalse(self.storage.exists("foo/missing.txt"))
+        # Directory names can contain dots.
+        self.storage.save("v1.2/file.txt", ContentFile(b"foo"))
+        try:
+            self.assertTrue(self.storage.exists("v1.2"))
+        finally:
+            self.storage.delete("v1.2/file.txt")
+
+    def testExistsChecksFileShard(self):
+        storage = GSStorage(**self.storage.deconstruct()[2])
+        # Files are checked with a HEAD request, without listing any shards.
+        storage._list = lambda *args, **kwargs: self.fail("Shards were listed")
+        self.assertTrue(storage.exists(self.names[0]))
+
+    def testBucket(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.storage.bucket
+        storage = GSStorage(**self.server.get_storage_kwargs(gcp_gs_bucket_name="media", gcp_gs_bucket_names=["media-2"]))
+        self.assertEqual(storage.bucket.name, "media-2")
+
+    def testStatMany(self):
+        stats = self.storage.stat_many(self.names + ["foo/missing.txt"])
+        self.assertEqual(stats[self.names[0]].size, len(self.names[0]))
+        self.assertEqual(stats["foo/missing.txt"], None)
+
+    def testSyncMeta(self):
+        self.assertEqual(sorted(self.storage.sync_meta_iter()), sorted(self.names))
+
+    def testUrl(self):
+        for name in self.names:
+            self.assertEqual(requests.get(self.storage.url(name)).content, force_bytes(name))
+
+    def testPublicUrl(self):
+        storage = GSStorage(**self.server.get_storage_kwargs(gcp_gs_bucket_name="media", gcp_gs_bucket_auth=False, gcp_gs_public_url="http://www.example.com/", gcp_gs_key_prefix_shards=4))
+        shard = storage._get_shard("foo.txt")
+        self.assertEqual(storage.url("foo.txt"), "http://www.example.com/{}/foo.txt".format(shard.prefix))
+        with self.assertRaises(ImproperlyConfigured):
+            GSStorage(**self.server.get_storage_kwargs(gcp_gs_bucket_auth=False, gcp_gs_public_url="http://www.example.com/", gcp_gs_bucket_names=["media", "media-2"]))
+
+    def testReadBucket(self):
+        name = next(name for name in self.names if self.storage._get_shard(name).bucket.name == "media")
+        # Files missing from the read bucket are read from the primary bucket.
+        self.assertEqual(self.storage.open(name).read(), force_bytes(name))
+        self.assertEqual(self.storage.size(name), len(name))
+        # Otherwise, files are read from the read bucket.
+        key_name = self.storage._get_key_name(name)
+        self.server.put_object("media-replica", key_name, b"replica", {}, "private")
+        try:
+            self.assertEqual(self.storage.open(name).read(), b"replica")
+            self.assertEqual(self.storage.size(name), len(b"replica"))
+        finally:
+            del self.server.buckets["media-replica"][key_name]
+
+    def testDelete(self):
+        self.storage.save("bar.txt", ContentFile(b"bar"))
+        self.assertTrue(self.storage.exists("bar.txt"))
+        self.storage.delete("bar.txt")
+        self.assertFalse(self.storage.exists("bar.txt"))
+
+
+@skipUnless(settings.GCP_REGION, "No settings.GCP_REGION supplied.")
+@skipUnless(settings.GCP_ACCESS_KEY_ID, "No settings.GCP_ACCESS_KEY_ID supplied.")
+@skipUnless(settings.GCP_SECRET_ACCESS_KEY, "No settings.GCP_SECRET_ACCESS_KEY supplied.")
+@skipUnless(settings.GCP_GS_BUCKET_NAME, "No settings.GCP_GS_BUCKET_NAME supplied.")
+@skipUnless(settings.GCP_GS_BUCKET_NAME_STATIC, "No settings.GCP_GS_BUCKET_NAME_STATIC supplied.")
+class TestGSStorageLive(TestGSStorage):
+
+    """
+    Runs the GSStorage tests against real GS buckets, configured in settings.
+    """
+
+    propagation_delay = 0.2
+
+    @classmethod
+    def startServer(cls):
+        cls.storage_kwargs = {}
+        cls.static_storage_kwargs = {}
+
+    @classmethod
+    def stopServer(cls):
+        pass
+
+    # Lazy settings tests.
+
+    def testLazySettingsInstanceLookup(self):
+        self.assertTrue(settings.GCP_REGION)
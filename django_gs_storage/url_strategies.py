@@ -0,0 +1,172 @@
+from __future__ import unicode_literals
+
+"""
+Strategies for generating file URLs.
+
+A strategy is a class taking the storage as its only argument, with a `url()`
+method. Set `GCP_GS_URL_STRATEGY` to the dotted path of a strategy to use it.
+"""
+
+import base64, hmac, math, posixpath, time
+from hashlib import sha1
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import filepath_to_uri, force_bytes, force_text
+from django.utils.six.moves.urllib.parse import urljoin, urlencode
+
+
+URL_VERSION_ETAG = "etag"
+
+URL_VERSION_GENERATION = "generation"
+
+CDN_COOKIE_NAME = "Cloud-CDN-Cookie"
+
+
+def _append_query(url, params):
+    return "{url}{sep}{query}".format(
+        url = url,
+        sep = "&" if "?" in url else "?",
+        query = urlencode(params),
+    )
+
+
+class DefaultUrlStrategy(object):
+
+    """
+    Generates URLs from `GCP_GS_PUBLIC_URL`, or from the GS bucket.
+
+    Bucket URLs are signed if bucket auth is enabled. Unsigned URLs can be
+    versioned with the file's ETag or generation, set by `GCP_GS_URL_VERSION`,
+    making them safe to cache forever.
+    """
+
+    # If True, URLs under `GCP_GS_PUBLIC_URL` can serve files uploaded with
+    # bucket auth.
+    serves_private_files = False
+
+    def __init__(self, storage):
+        self.storage = storage
+        if storage.gcp_gs_url_version not in ("", URL_VERSION_ETAG, URL_VERSION_GENERATION):
+            raise ImproperlyConfigured('GCP_GS_URL_VERSION must be "", "etag" or "generation".')
+
+    def get_version_params(self, name):
+        """
+        Returns the query parameters identifying the current version of the
+        given file.
+
+        Versions are taken from metadata prefetched by `stat_batch()`, or
+        cached when the file was saved or last looked up, if possible.
+        Otherwise, the file metadata is loaded with a HEAD request.
+        """
+        version = self.storage.gcp_gs_url_version
+        if not version:
+            return []
+        file_version = self.storage._get_version(name)
+        # Missing files have no version.
+        if file_version is None:
+            return []
+        etag, generation = file_version
+        if version == URL_VERSION_ETAG:
+            return [("v", etag.strip('"'))]
+        return [("generation", generation)]
+
+    def get_public_url(self, name):
+        """Returns the unsigned URL of the given file under `GCP_GS_PUBLIC_URL`."""
+        return urljoin(self.storage.gcp_gs_public_url, filepath_to_uri(posixpath.join(self.storage._get_shard(name).prefix, name)))
+
+    def url(self, name):
+        if self.storage.gcp_gs_public_url:
+            url = self.get_public_url(name)
+        else:
+            url = self.storage._generate_url(name)
+            # Signed URLs are unique anyway.
+            if self.storage.gcp_gs_bucket_auth:
+                return url
+        params = self.get_version_params(name)
+        return _append_query(url, params) if params else url
+
+
+class CloudCdnSignedUrlStrategy(DefaultUrlStrategy):
+
+    """
+    Generates Cloud CDN signed URLs under `GCP_GS_PUBLIC_URL`, using the
+    signing key named `GCP_GS_CDN_KEY_NAME`, with the base64-encoded secret
+    `GCP_GS_CDN_KEY`.
+
+    Expiry times are rounded up to a multiple of `GCP_GS_MAX_AGE_SECONDS`, so
+    the URL of a file only changes once per period, and can be cached by
+    browsers and the CDN. URLs are valid for between one and two periods.
+
+    Use with `GCP_GS_BUCKET_AUTH`, so files are private in GS, and can only be
+    read through a CDN backend bucket with access to them.
+    """
+
+    serves_private_files = True
+
+    sign_urls = True
+
+    def __init__(self, storage):
+        super(CloudCdnSignedUrlStrategy, self).__init__(storage)
+        if not storage.gcp_gs_public_url:
+            raise ImproperlyConfigured("GCP_GS_PUBLIC_URL is required for Cloud CDN URLs.")
+        if not storage.gcp_gs_cdn_key_name or not storage.gcp_gs_cdn_key:
+            raise ImproperlyConfigured("GCP_GS_CDN_KEY_NAME and GCP_GS_CDN_KEY are required for Cloud CDN URLs.")
+        self.key_name = storage.gcp_gs_cdn_key_name
+        # Decode the key once, and copy the keyed HMAC for each signature.
+        self._hmac = hmac.new(base64.urlsafe_b64decode(force_bytes(storage.gcp_gs_cdn_key)), digestmod=sha1)
+
+    def sign(self, value):
+        """Returns the URL-safe base64 signature of the given value."""
+        signer = self._hmac.copy()
+        signer.update(force_bytes(value))
+        return force_text(base64.urlsafe_b64encode(signer.digest()))
+
+    def get_expires(self, now=None):
+        """Returns the expiry timestamp for URLs and cookies signed now."""
+        period = self.storage.gcp_gs_max_age_seconds
+        now = time.time() if now is None else now
+        return int(math.ceil((now + period) / float(period)) * period)
+
+    def url(self, name):
+        url = self.get_public_url(name)
+        params = self.get_version_params(name)
+        if params:
+            url = _append_query(url, params)
+        if not self.sign_urls:
+            return url
+        url = _append_query(url, [
+            ("Expires", self.get_expires()),
+            ("KeyName", self.key_name),
+        ])
+        # The signature is URL-safe base64, and appended unescaped.
+        return "{url}&Signature={signature}".format(
+            url = url,
+            signature = self.sign(url),
+        )
+
+    def get_signed_cookie(self, url_prefix=None):
+        """
+        Returns the value of a Cloud CDN signed cookie, granting access to all
+        URLs starting with `url_prefix` (by default, `GCP_GS_PUBLIC_URL`).
+
+        Set the value as the `Cloud-CDN-Cookie` cookie on a response.
+        """
+        policy = "URLPrefix={url_prefix}:Expires={expires}:KeyName={key_name}".format(
+            url_prefix = force_text(base64.urlsafe_b64encode(force_bytes(url_prefix or self.storage.gcp_gs_public_url))),
+            expires = self.get_expires(),
+            key_name = self.key_name,
+        )
+        return "{policy}:Signature={signature}".format(
+            policy = policy,
+            signature = self.sign(policy),
+        )
+
+
+class CloudCdnSignedCookieStrategy(CloudCdnSignedUrlStrategy):
+
+    """
+    Generates unsigned URLs under `GCP_GS_PUBLIC_URL`, for use with Cloud CDN
+    signed cookies from `get_signed_cookie()`.
+    """
+
+    sign_urls = False
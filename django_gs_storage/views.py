@@ -0,0 +1,27 @@
+from __future__ import unicode_literals
+
+"""
+Views used by django-gs-storage.
+"""
+
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
+
+
+def serve_staged(request, path, check_access, storage=default_storage):
+    """
+    Serves a file saved in write-behind mode that has not been uploaded yet.
+
+    Route `GCP_GS_WRITE_BEHIND_URL` to this view. `check_access` must be given
+    in the URLconf, and is called with the request and path, returning True if
+    the request may read the file. Files that are not staged, including files
+    that have since been uploaded, return 404. A storage other than the
+    default storage can also be given in the URLconf.
+    """
+    if not check_access(request, path):
+        raise PermissionDenied
+    content = storage.upload_queue.open(path) if storage.upload_queue is not None else None
+    if content is None:
+        raise Http404("{} is not staged".format(path))
+    return FileResponse(content, content_type=storage._get_content_type(path))
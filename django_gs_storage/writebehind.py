@@ -0,0 +1,422 @@
+from __future__ import unicode_literals
+
+"""
+A write-behind queue, uploading saved files to GS in the background.
+"""
+
+import os, json, time, uuid, zlib, socket, hashlib, logging, tempfile, threading
+from contextlib import contextmanager
+
+from django.core.files.base import File
+from django.utils.encoding import force_bytes
+from django.utils.six.moves import queue
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = ".index"
+
+
+class StagedUpload(object):
+
+    """
+    A file waiting in the staging directory to be uploaded.
+    """
+
+    __slots__ = ("name", "path", "queued_time", "failed")
+
+    def __init__(self, name, path, queued_time):
+        self.name = name
+        self.path = path
+        self.queued_time = queued_time
+        self.failed = False
+
+    @property
+    def meta_path(self):
+        return self.path + ".json"
+
+
+def _lock(path, create):
+    """
+    Takes an exclusive lock on the given lock file, returning its descriptor.
+
+    If `create` is True, the lock file is created if required, and this
+    blocks until the lock is available. Otherwise, None is returned if the
+    lock file is missing or locked by another process.
+    """
+    import fcntl  # Not available on Windows, so only imported if write-behind is used.
+    while True:
+        try:
+            fd = os.open(path, (os.O_RDWR | os.O_CREAT) if create else os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if create else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Check the lock file wasn't removed while waiting for the lock.
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd
+        except (IOError, OSError):
+            pass
+        os.close(fd)
+        if not create:
+            return None
+
+
+class UploadQueue(object):
+
+    """
+    Uploads files to a `GSStorage` in the background.
+
+    Saved files are written to a local staging directory, then uploaded by a
+    pool of worker threads, retrying failed uploads with exponential backoff.
+    Uploads of the same name are always handled by the same worker, in the
+    order they were saved.
+
+    Each queue stages files in its own subdirectory of `root_directory`,
+    locked until the queue is closed, so several queues can share a root
+    directory. Files left by queues on this host that have been closed, or
+    whose process has exited, are uploaded when a queue is created. A forked
+    process starts a new subdirectory and worker threads when it first uses
+    the queue.
+
+    An index in `root_directory` maps each name to its latest staged file, so
+    every queue sharing the root directory sees files staged by the others.
+    Monitoring only covers files staged by this queue.
+    """
+
+    def __init__(self, storage, root_directory, workers=4, retries=5, retry_delay=1.0):
+        self.storage = storage
+        self.root_directory = root_directory
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        try:
+            os.makedirs(root_directory)
+        except OSError:
+            if not os.path.isdir(root_directory):
+                raise
+        self._index_directory = os.path.join(root_directory, INDEX_NAME)
+        try:
+            os.mkdir(self._index_directory)
+        except OSError:
+            if not os.path.isdir(self._index_directory):
+                raise
+        self._start()
+        self._recover()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._host_prefix = "{}-".format(socket.gethostname())
+        self.directory = os.path.join(self.root_directory, "{}{}-{}".format(self._host_prefix, self._pid, uuid.uuid4().hex))
+        self._lock_fd = _lock(self.directory + ".lock", create=True)
+        try:
+            os.mkdir(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        self._lock = threading.Lock()
+        self._staged = {}
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._threads = []
+
+    def _check_fork(self):
+        # Files staged before a fork are uploaded by the parent.
+        if self._pid != os.getpid():
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+            self._start()
+
+    def close(self):
+        """
+        Waits for queued uploads, stops the worker threads, and unlocks the
+        staging directory. Failed uploads are left for a later process.
+        """
+        if self._lock_fd is None:
+            return
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    # Monitoring.
+
+    @property
+    def depth(self):
+        """The number of files waiting to be uploaded."""
+        with self._lock:
+            return len(self._staged)
+
+    @property
+    def lag(self):
+        """The time, in seconds, that the oldest waiting file has been queued."""
+        with self._lock:
+            if not self._staged:
+                return 0
+            return time.time() - min(upload.queued_time for upload in self._staged.values())
+
+    @property
+    def failed(self):
+        """The number of files that could not be uploaded after retrying."""
+        with self._lock:
+            return sum(1 for upload in self._staged.values() if upload.failed)
+
+    # Index.
+
+    @contextmanager
+    def _lock_index(self):
+        fd = _lock(self._index_directory + ".lock", create=True)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    def _get_index_path(self, name):
+        return os.path.join(self._index_directory, hashlib.sha1(force_bytes(name)).hexdigest())
+
+    def _read_index(self, name):
+        try:
+            with open(self._get_index_path(name)) as handle:
+                return json.load(handle)
+        except (IOError, OSError):
+            return None
+
+    def _write_index(self, upload):
+        with tempfile.NamedTemporaryFile("w", dir=self._index_directory, suffix=".tmp", delete=False) as handle:
+            json.dump({"name": upload.name, "filename": os.path.basename(upload.path), "queued_time": upload.queued_time}, handle)
+        os.rename(handle.name, self._get_index_path(upload.name))
+
+    def _remove_index(self, name):
+        try:
+            os.remove(self._get_index_path(name))
+        except OSError:
+            pass
+
+    def _is_indexed(self, upload):
+        entry = self._read_index(upload.name)
+        return entry is not None and entry["filename"] == os.path.basename(upload.path)
+
+    def _find(self, filename):
+        """Returns the path of a staged file in any queue's directory, or None."""
+        directories = [self.directory] + [
+            os.path.join(self.root_directory, name)
+            for name in os.listdir(self.root_directory)
+            if name != INDEX_NAME and not name.endswith(".lock")
+        ]
+        for directory in directories:
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                return path
+        return None
+
+    # Staging.
+
+    def _write_meta(self, upload):
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as handle:
+            json.dump({"name": upload.name, "queued_time": upload.queued_time}, handle)
+        os.rename(handle.name, upload.meta_path)
+
+    def _remove_files(self, upload):
+        for path in (upload.meta_path, upload.path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _adopt(self, name):
+        """
+        Moves the files staged by another queue into this queue's staging
+        directory, if that queue has been closed or its process has exited.
+        """
+        lock_path = os.path.join(self.root_directory, name + ".lock")
+        fd = _lock(lock_path, create=False)
+        if fd is None:
+            return
+        try:
+            directory = os.path.join(self.root_directory, name)
+            if os.path.isdir(directory):
+                for filename in os.listdir(directory):
+                    os.rename(os.path.join(directory, filename), os.path.join(self.directory, filename))
+                os.rmdir(directory)
+            os.remove(lock_path)
+        finally:
+            os.close(fd)
+
+    def _recover(self):
+        # Adopt the files of queues on this host that are no longer running.
+        for filename in os.listdir(self.root_directory):
+            name = filename[:-5]
+            if filename.endswith(".lock") and name.startswith(self._host_prefix) and name != os.path.basename(self.directory):
+                self._adopt(name)
+        filenames = set(os.listdir(self.directory))
+        uploads = []
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".json"):
+                if filename[:-5] in filenames:
+                    with open(path) as handle:
+                        meta = json.load(handle)
+                    uploads.append(StagedUpload(meta["name"], path[:-5], meta["queued_time"]))
+                    continue
+            elif not filename.endswith(".tmp") and filename + ".json" in filenames:
+                continue
+            # Interrupted while staging or cleaning up.
+            os.remove(path)
+        # Data files are named in the order they were saved. Files that were
+        # saved again or deleted since are dropped.
+        for upload in sorted(uploads, key=lambda upload: upload.path):
+            if self._is_indexed(upload):
+                self._enqueue(upload)
+            else:
+                self._remove_files(upload)
+
+    def _enqueue(self, upload):
+        with self._lock:
+            previous = self._staged.get(upload.name)
+            self._staged[upload.name] = upload
+            if not self._threads:
+                for worker_queue in self._queues:
+                    thread = threading.Thread(target=self._work, args=(worker_queue,))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        # Failed uploads are not queued, so clean up after them here.
+        if previous is not None and previous.failed:
+            self._remove_files(previous)
+        self._queues[(zlib.crc32(force_bytes(upload.name)) & 0xffffffff) % len(self._queues)].put(upload)
+
+    def put(self, name, content):
+        """
+        Copies the given bytes-mode file to the staging directory, and queues
+        it for upload.
+
+        Returns the name.
+        """
+        self._check_fork()
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as handle:
+            for chunk in content.chunks():
+                handle.write(chunk)
+            handle.flush()
+            os.fsync(handle.fileno())
+        upload = StagedUpload(
+            name = name,
+            path = os.path.join(self.directory, "{:020d}-{}".format(int(time.time() * 1000000), uuid.uuid4().hex)),
+            queued_time = time.time(),
+        )
+        os.rename(handle.name, upload.path)
+        # The metadata is written after the data, marking the upload as complete.
+        self._write_meta(upload)
+        with self._lock_index():
+            self._write_index(upload)
+        self._enqueue(upload)
+        return name
+
+    def get(self, name):
+        """
+        Returns the `StagedUpload` for the given name, staged by any queue
+        sharing the root directory, or None.
+        """
+        self._check_fork()
+        entry = self._read_index(name)
+        if entry is None:
+            return None
+        with self._lock:
+            upload = self._staged.get(name)
+        if upload is not None and os.path.basename(upload.path) == entry["filename"]:
+            return upload
+        # Staged by another queue.
+        path = self._find(entry["filename"])
+        if path is None:
+            return None  # Uploaded in the meantime.
+        return StagedUpload(name, path, entry["queued_time"])
+
+    def open(self, name):
+        """
+        Returns the staged copy of the given file, or None if it has been
+        uploaded.
+        """
+        upload = self.get(name)
+        if upload is not None:
+            try:
+                return File(open(upload.path, "rb"), name)
+            except (IOError, OSError):
+                pass  # Uploaded in the meantime.
+        return None
+
+    def discard(self, name):
+        """
+        Cancels the upload of the given file.
+
+        Returns True if the file was waiting to be uploaded.
+        """
+        self._check_fork()
+        with self._lock_index():
+            discarded = self._read_index(name) is not None
+            self._remove_index(name)
+        with self._lock:
+            upload = self._staged.pop(name, None)
+        if upload is not None and upload.failed:
+            self._remove_files(upload)
+        return discarded
+
+    def flush(self):
+        """Waits until all queued files have been uploaded, or have failed."""
+        for worker_queue in self._queues:
+            worker_queue.join()
+
+    # Uploading.
+
+    def _forget(self, upload):
+        with self._lock:
+            if self._staged.get(upload.name) is upload:
+                del self._staged[upload.name]
+
+    def _upload(self, upload):
+        for attempt in range(self.retries + 1):
+            # Skip files that were saved again or deleted.
+            if not self._is_indexed(upload):
+                self._forget(upload)
+                self._remove_files(upload)
+                return
+            try:
+                with open(upload.path, "rb") as handle:
+                    self.storage._upload(upload.name, File(handle, upload.name))
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception("Failed to upload %s to GS", upload.name)
+                    # Leave the file staged, to be retried by the next process.
+                    upload.failed = self._is_indexed(upload)
+                    if not upload.failed:
+                        self._forget(upload)
+                        self._remove_files(upload)
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+            else:
+                break
+        with self._lock_index():
+            entry = self._read_index(upload.name)
+            if entry is not None and entry["filename"] == os.path.basename(upload.path):
+                self._remove_index(upload.name)
+        self._forget(upload)
+        self._remove_files(upload)
+        # Deleted while uploading.
+        if entry is None:
+            try:
+                self.storage.delete(upload.name)
+            except Exception:
+                logger.exception("Failed to delete %s from GS", upload.name)
+
+    def _work(self, worker_queue):
+        while True:
+            upload = worker_queue.get()
+            if upload is None:
+                worker_queue.task_done()
+                return
+            try:
+                self._upload(upload)
+            except Exception:
+                logger.exception("Failed to upload %s to GS", upload.name)
+            finally:
+                worker_queue.task_done()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Benchmarks for GSStorage hot paths.
+
+Runs against a local fake GS server, so results are reproducible and don't
+depend on network conditions. Use --latency and --bandwidth to simulate a real
+network. Each benchmark runs in a new process, with the fake server left in
+this process, so its peak RSS isn't hidden by earlier benchmarks or inflated
+by the files held by the server.
+
+Example usage:
+
+    python tests/benchmark.py --output before.json
+    python tests/benchmark.py --output after.json --compare before.json
+"""
+from __future__ import print_function, unicode_literals
+
+import os, sys, json, time, uuid, posixpath, argparse, platform, resource, subprocess, datetime
+
+from django_gs_storage.loadtest import percentile, random_bytes, text_bytes
+
+
+timer = getattr(time, "perf_counter", time.time)
+
+KB = 1024
+
+MB = 1024 * 1024
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process, in bytes.
+
+    This is the peak over the lifetime of the process, so each benchmark is
+    run in its own process. On Linux, `ru_maxrss` includes the parent's peak
+    at the time the process was started, so the peak is read from /proc.
+    """
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * KB
+    except (IOError, OSError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return rss if sys.platform == "darwin" else rss * KB
+
+
+def text_str(size):
+    """Returns compressible, reproducible, unicode text."""
+    return text_bytes(size).decode("ascii")
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return "{:g}{}".format(round(size, 1), unit)
+        size /= 1024.0
+
+
+class Benchmark(object):
+
+    """
+    A single benchmark.
+
+    `run` is called once per iteration, and returns the number of payload
+    bytes transferred (or 0). `populate` is called with the fake GS server,
+    in the process running the server, before the benchmark is run.
+    """
+
+    def __init__(self, name, run, iterations, setup=None, teardown=None, populate=None):
+        self.name = name
+        self.run = run
+        self.iterations = iterations
+        self.setup = setup
+        self.teardown = teardown
+        self.populate = populate
+
+    def measure(self, warmup=1):
+        if self.setup:
+            self.setup()
+        try:
+            for _ in range(warmup):
+                self.run(-1)
+            durations = []
+            total_bytes = 0
+            start = timer()
+            for i in range(self.iterations):
+                op_start = timer()
+                total_bytes += self.run(i) or 0
+                durations.append(timer() - op_start)
+            elapsed = timer() - start
+        finally:
+            if self.teardown:
+                self.teardown()
+        durations.sort()
+        return {
+            "iterations": self.iterations,
+            "elapsed": elapsed,
+            "ops_per_sec": self.iterations / elapsed,
+            "bytes_per_sec": total_bytes / elapsed,
+            "latency_mean": sum(durations) / len(durations),
+            "latency_p50": percentile(durations, 50),
+            "latency_p90": percentile(durations, 90),
+            "latency_p99": percentile(durations, 99),
+            "latency_max": durations[-1],
+            "peak_rss": peak_rss(),
+        }
+
+
+def build_benchmarks(storage_kwargs, prefix, scale):
+    from django.core.files.base import ContentFile
+    from django_gs_storage.storage import GSStorage
+    storage = GSStorage(**dict(storage_kwargs, gcp_gs_bucket_name="media"))
+    public_storage = GSStorage(**dict(storage_kwargs, gcp_gs_bucket_name="media", gcp_gs_bucket_auth=False, gcp_gs_public_url="https://cdn.example.com/"))
+    benchmarks = []
+
+    def path(*parts):
+        return posixpath.join(prefix, *parts)
+
+    def iterations(size, base):
+        return max(3, int(base * scale * min(1, float(MB) / size)))
+
+    # Saving files, with and without gzip, and from text-mode files.
+    for size in (KB, 64 * KB, MB, 8 * MB):
+        for label, extension, make_content in (("gzip", "txt", text_bytes), ("plain", "bin", random_bytes), ("text", "txt", text_str)):
+            # The payload is only created in the process running the benchmark.
+            payload = {}
+
+            def setup_save(payload=payload, make_content=make_content, size=size):
+                payload["data"] = make_content(size)
+
+            def run_save(i, payload=payload, label=label, extension=extension):
+                data = payload["data"]
+                storage._save(path("save", label, "{}.{}".format(i, extension)), ContentFile(data))
+                return len(data)
+            benchmarks.append(Benchmark("save_{}_{}".format(label, format_size(size)), run_save, iterations(size, 50), setup=setup_save))
+
+    # Opening files.
+    for label, size in (("small", KB), ("large", 8 * MB)):
+        name = path("open", "{}.bin".format(label))
+
+        def populate_open(server, name=name, size=size):
+            server.put_object(storage.gcp_gs_bucket_name, storage._get_key_name(name), random_bytes(size), {}, "private")
+
+        def run_open(i, name=name):
+            with storage.open(name) as handle:
+                return len(handle.read())
+        benchmarks.append(Benchmark("open_{}".format(label), run_open, iterations(size, 200), populate=populate_open))
+
+    # Generating URLs.
+    for label, url_storage in (("public", public_storage), ("signed", storage)):
+        def run_url(i, url_storage=url_storage):
+            url_storage.url(path("url", "file.txt"))
+        benchmarks.append(Benchmark("url_{}".format(label), run_url, int(5000 * scale)))
+
+    # Checking for existence.
+    exists_name = path("exists", "file.txt")
+
+    def populate_exists(server):
+        server.put_object(storage.gcp_gs_bucket_name, storage._get_key_name(exists_name), b"exists", {}, "private")
+
+    def run_exists(i):
+        storage.exists(exists_name)
+    benchmarks.append(Benchmark("exists", run_exists, int(500 * scale), populate=populate_exists))
+
+    # Listing large directories. The fake server is populated directly, for speed.
+    listdir_count = int(5000 * scale) or 1
+
+    def populate_listdir(server):
+        for i in range(listdir_count):
+            server.put_object(storage.gcp_gs_bucket_name, storage._get_key_name(path("listdir", "{}.txt".format(i))), b"x", {}, "private")
+
+    def run_listdir(i):
+        storage.listdir(path("listdir"))
+    benchmarks.append(Benchmark("listdir_{}".format(listdir_count), run_listdir, 5, populate=populate_listdir))
+
+    # Syncing metadata.
+    sync_count = int(200 * scale) or 1
+    sync_storage = GSStorage(**dict(storage_kwargs, gcp_gs_bucket_name="sync", gcp_gs_key_prefix=prefix))
+
+    def populate_sync_meta(server):
+        for i in range(sync_count):
+            server.put_object("sync", posixpath.join(prefix, "dir{}".format(i % 10), "{}.txt".format(i)), b"x", {}, "private")
+
+    def run_sync_meta(i):
+        for _ in sync_storage.sync_meta_iter():
+            pass
+    benchmarks.append(Benchmark("sync_meta_iter_{}".format(sync_count), run_sync_meta, 3, populate=populate_sync_meta))
+    return benchmarks
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_isolated(name, args, storage_kwargs, prefix):
+    """
+    Runs the named benchmark in a new process, returning its result.
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--run-one", name,
+        "--scale", str(args.scale),
+        "--storage-kwargs", json.dumps(storage_kwargs),
+        "--prefix", prefix,
+    ]
+    output = subprocess.check_output(command).decode("utf-8")
+    return json.loads(output.splitlines()[-1])
+
+
+def compare(results, baseline_results):
+    print()
+    print("{:<28} {:>12} {:>12} {:>9}".format("benchmark", "baseline", "current", "change"))
+    for name, result in sorted(results.items()):
+        baseline = baseline_results.get(name)
+        if baseline is None:
+            continue
+        change = (result["ops_per_sec"] - baseline["ops_per_sec"]) / baseline["ops_per_sec"] * 100
+        print("{:<28} {:>10.1f}/s {:>10.1f}/s {:>+8.1f}%".format(name, baseline["ops_per_sec"], result["ops_per_sec"], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks GSStorage against a fake GS server.")
+    parser.add_argument("--output", help="Save the results as JSON to this path.")
+    parser.add_argument("--compare", help="Compare the results against a previously saved JSON file.")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this string.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the number of iterations.")
+    parser.add_argument("--latency", type=float, default=0, help="Simulated network latency, in seconds.")
+    parser.add_argument("--bandwidth", type=int, default=None, help="Simulated network bandwidth, in bytes per second.")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--storage-kwargs", help=argparse.SUPPRESS)
+    parser.add_argument("--prefix", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # Configure Django.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_gs_storage_test.settings")
+    import django
+    django.setup()
+    from django_gs_storage.testing import FakeGSServer
+    # Run a single benchmark against the parent process's server, and print
+    # the result for the parent process.
+    if args.run_one:
+        benchmarks = build_benchmarks(json.loads(args.storage_kwargs), args.prefix, args.scale)
+        benchmark = next(benchmark for benchmark in benchmarks if benchmark.name == args.run_one)
+        print(json.dumps(benchmark.measure()))
+        return
+    # Run the benchmarks.
+    results = {}
+    with FakeGSServer(latency=args.latency, bandwidth=args.bandwidth) as server:
+        storage_kwargs = server.get_storage_kwargs()
+        prefix = uuid.uuid4().hex
+        benchmarks = build_benchmarks(storage_kwargs, prefix, args.scale)
+        print("{:<28} {:>12} {:>12} {:>10} {:>10} {:>10} {:>10}".format("benchmark", "ops/sec", "bytes/sec", "p50 ms", "p90 ms", "p99 ms", "peak RSS"))
+        for benchmark in benchmarks:
+            if args.filter not in benchmark.name:
+                continue
+            if benchmark.populate:
+                benchmark.populate(server)
+            result = results[benchmark.name] = run_isolated(benchmark.name, args, storage_kwargs, prefix)
+            print("{:<28} {:>12.1f} {:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10}".format(
+                benchmark.name,
+                result["ops_per_sec"],
+                format_size(result["bytes_per_sec"]) + "/s" if result["bytes_per_sec"] else "-",
+                result["latency_p50"] * 1000,
+                result["latency_p90"] * 1000,
+                result["latency_p99"] * 1000,
+                format_size(result["peak_rss"]),
+            ))
+            sys.stdout.flush()
+    # Save the results.
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({
+                "revision": get_git_revision(),
+                "timestamp": datetime.datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "options": {
+                    "scale": args.scale,
+                    "latency": args.latency,
+                    "bandwidth": args.bandwidth,
+                },
+                "results": results,
+            }, handle, indent=2, sort_keys=True)
+    # Compare the results.
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(results, json.load(handle)["results"])
+
+
+if __name__ == "__main__":
+    main()